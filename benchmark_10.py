@@ -0,0 +1,449 @@
+#!/bin/env python
+"""
+Benchmark and regression harness for the program_10 pipeline.
+
+Synthetic USGS RDB files of a chosen length and number of sites are written
+to a work directory, and every stage (ReadData, ClipData,
+GetAnnualStatistics, GetMonthlyStatistics, GetAnnualAverages and
+GetMonthlyAverages) is timed over all sites for wall time and peak traced
+memory.  Before timing, the two bundled gauge files are run through the
+pipeline and checked against the committed Annual_Metrics.csv and
+Monthly_Metrics.csv, and every registered metric engine backend (numpy, and
+numba when installed) is checked against the single-series functions of
+program_10 on the gauges and on short and NaN-heavy periods.  The stages
+are timed with the backend chosen by --backend.  Results are written as
+JSON; given the JSON of an earlier run, stages that got slower than the
+threshold are flagged and the run exits with status 1.
+
+    python benchmark_10.py --sites 20 --years 60 --output new.json \
+        --baseline old.json --threshold 0.25 --backend numba
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import metric_engine
+from metric_engine import CalcPeriodMetrics, METRICS
+from program_10 import (ReadData, ClipData, GetAnnualStatistics,
+                        GetMonthlyStatistics, GetAnnualAverages,
+                        GetMonthlyAverages, CalcTqmean, CalcRBindex, Calc7Q,
+                        CalcExceed3TimesMedian)
+
+# directory holding the bundled gauge files and golden outputs
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# bundled gauge files, keyed by the Station name used in the golden outputs
+GOLDEN_FILES = {
+    "Wildcat": "WildcatCreek_Discharge_03335000_19540601-20200315.txt",
+    "Tippe": "TippecanoeRiver_Discharge_03331500_19431001-20200315.txt"}
+GOLDEN_PERIOD = ('1969-10-01', '2019-09-30')
+
+# relative tolerance of the golden comparison
+GOLDEN_RTOL = 1e-9
+
+# relative tolerance of the backend comparison
+BACKEND_RTOL = 1e-10
+
+# resample rule of each period, as program_10 resampled before the engine
+PERIOD_RULES = {'WY': 'AS-OCT', 'M': 'MS'}
+
+# run settings that must match the baseline for a comparison to mean anything
+COMPARED_META = ['sites', 'years', 'repeat', 'seed', 'backend']
+
+RDB_HEADER = """# Synthetic daily discharge written by benchmark_10.py
+#
+# Data provided for site {site}
+#            TS   parameter     statistic     Description
+#         99999       00060     00003     Discharge, cubic feet per second (Mean)
+#
+agency_cd\tsite_no\tdatetime\t99999_00060_00003\t99999_00060_00003_cd
+5s\t15s\t20d\t14n\t10s
+"""
+
+
+def WriteSyntheticRDB(fileName, siteNo, startDate='1950-10-01', years=60,
+                      seed=0, noData=0.003):
+    """This function writes a synthetic daily discharge record in the USGS
+    RDB layout: a seasonal, autocorrelated log-normal flow series with a
+    fraction noData of the days flagged 'Eqp' or left empty, and a mix of
+    quality codes.  The routine returns the number of data rows."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(startDate, periods=int(round(years*365.25)),
+                          freq='D')
+    n = len(dates)
+    # AR(1) noise around a seasonal cycle in log space
+    noise = np.empty(n)
+    noise[0] = 0.0
+    shocks = rng.normal(0.0, 0.35, n)
+    for i in range(1, n):
+        noise[i] = 0.9*noise[i - 1] + shocks[i]
+    season = 0.8*np.cos(2*np.pi*(dates.dayofyear.values - 80)/365.25)
+    flow = np.round(np.exp(6.0 + season + noise), 0)
+    values = flow.astype(np.int64).astype(str).astype(object)
+    quality = rng.choice(['A', 'A:e', 'P'], size=n, p=[0.94, 0.05, 0.01])
+    flagged = rng.random(n) < noData
+    half = rng.random(n) < 0.5
+    values[flagged & half] = 'Eqp'
+    values[flagged & ~half] = ''
+    quality = quality.astype(object)
+    quality[flagged & ~half] = ''
+    rows = pd.DataFrame({'agency_cd': 'USGS', 'site_no': siteNo,
+                         'datetime': dates.strftime('%Y-%m-%d'),
+                         'value': values, 'code': quality})
+    with open(fileName, 'w') as f:
+        f.write(RDB_HEADER.format(site=siteNo))
+        rows.to_csv(f, sep='\t', header=False, index=False)
+    return( n )
+
+
+def ReadGolden(fileName):
+    """This function reads a committed metrics CSV file.  Header lines
+    repeated inside the file (one per station, as older versions of
+    program_10 wrote them) are skipped."""
+    table = pd.read_csv(fileName, index_col=0, dtype=str)
+    table = table[table.index != table.index.name]
+    table.index = pd.DatetimeIndex(pd.to_datetime(table.index,
+                                                  format='%Y-%m-%d'),
+                                   name=table.index.name)
+    for name in table.columns:
+        if name != 'Station':
+            table[name] = pd.to_numeric(table[name])
+    return( table )
+
+
+def CheckGolden():
+    """This function runs the bundled gauge files through the pipeline and
+    compares the annual and monthly tables with the committed
+    Annual_Metrics.csv and Monthly_Metrics.csv.  The routine returns a
+    dictionary with 'ok' and the largest relative error per table."""
+    report = {'ok': True}
+    golden = {'annual': ReadGolden(os.path.join(REPO_DIR, 'Annual_Metrics.csv')),
+              'monthly': ReadGolden(os.path.join(REPO_DIR, 'Monthly_Metrics.csv'))}
+    for name in golden:
+        report[name] = 0.0
+    for station, fileName in GOLDEN_FILES.items():
+        DataDF, MissingValues = ReadData(os.path.join(REPO_DIR, fileName))
+        DataDF, MissingValues = ClipData(DataDF, *GOLDEN_PERIOD)
+        tables = {'annual': GetAnnualStatistics(DataDF),
+                  'monthly': GetMonthlyStatistics(DataDF)}
+        for name, table in tables.items():
+            expected = golden[name][golden[name]['Station'] == station]
+            expected = expected.drop(columns='Station')
+            if (list(expected.columns) != list(table.columns)
+                    or not expected.index.equals(table.index)):
+                report['ok'] = False
+                report[name] = float('inf')
+                continue
+            a = table.to_numpy(dtype=np.float64)
+            b = expected.to_numpy(dtype=np.float64)
+            if not np.array_equal(np.isnan(a), np.isnan(b)):
+                report['ok'] = False
+                report[name] = float('inf')
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                error = np.nanmax(np.abs(a - b)/np.maximum(np.abs(b), 1e-300))
+            report[name] = max(report[name], float(error))
+            if error > GOLDEN_RTOL:
+                report['ok'] = False
+    return( report )
+
+
+def ReferenceStatistics(DataDF, period):
+    """This function computes the metrics of every water year ('WY') or
+    month ('M') one period at a time with pandas resampling, scipy's skew
+    and the single-series functions of program_10, the way program_10 did
+    before the metric engine.  The routine returns a DataFrame with the
+    METRICS columns."""
+    from scipy import stats
+    Qvalues = DataDF['Discharge'].resample(PERIOD_RULES[period])
+    return( pd.DataFrame({'Mean Flow': Qvalues.mean(),
+                          'Peak Flow': Qvalues.max(),
+                          'Median Flow': Qvalues.median(),
+                          'Coeff Var': Qvalues.std()/Qvalues.mean()*100,
+                          'Skew': Qvalues.apply(lambda x: stats.skew(x)),
+                          'Tqmean': Qvalues.apply(CalcTqmean),
+                          'R-B index': Qvalues.apply(CalcRBindex),
+                          '7Q': Qvalues.apply(Calc7Q),
+                          '3xMedian': Qvalues.apply(CalcExceed3TimesMedian)},
+                         columns=METRICS) )
+
+
+def MakeEdgeCases():
+    """This function returns a daily discharge DataFrame whose water years
+    and months hold the awkward cases of the metrics: a single day, fewer
+    days than the 7-day window, no valid day, mostly NoData days, constant
+    flow and a ragged last month."""
+    rng = np.random.default_rng(1)
+    dates = pd.date_range('2000-10-01', '2006-09-17', freq='D')
+    flow = np.round(np.exp(rng.normal(5.0, 1.0, len(dates))), 0)
+    discharge = pd.Series(np.nan, index=dates)
+    discharge['2000-10-01':'2001-09-30'] = flow[:365]
+    discharge['2001-10-05'] = 12.0
+    discharge['2002-10-10':'2002-10-14'] = [3.0, 1.0, 4.0, 1.0, 5.0]
+    mostlyNaN = discharge['2003-10-01':'2004-09-30'].index
+    keep = rng.random(len(mostlyNaN)) < 0.15
+    discharge[mostlyNaN[keep]] = flow[:keep.sum()]
+    discharge['2004-10-01':'2005-09-30'] = 250.0
+    discharge['2005-10-01':] = flow[-len(discharge['2005-10-01':]):]
+    discharge['2006-09-10':'2006-09-12'] = np.nan
+    return( pd.DataFrame({'site_no': 3300000.0, 'Discharge': discharge},
+                         index=pd.DatetimeIndex(dates, name='Date')) )
+
+
+def CompareTables(table, expected, rtol):
+    """This function returns the largest relative difference between two
+    tables of the same shape, inf when their NaN cells differ."""
+    a = table.to_numpy(dtype=np.float64)
+    b = expected.to_numpy(dtype=np.float64)
+    if a.shape != b.shape or not np.array_equal(np.isnan(a), np.isnan(b)):
+        return( float('inf') )
+    if not np.isfinite(b).any():
+        return( 0.0 )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = np.abs(a - b)/np.maximum(np.abs(b), 1e-300)
+    return( float(np.nanmax(error)) )
+
+
+def CheckBackends():
+    """This function computes the metrics of the bundled gauge files and of
+    MakeEdgeCases with every registered backend of the metric engine and
+    compares them with ReferenceStatistics.  The routine returns a
+    dictionary with 'ok' and, per backend, the largest relative error."""
+    # the compiled backend registers itself when numba is installed
+    import metric_kernels
+    cases = {}
+    for station, fileName in GOLDEN_FILES.items():
+        DataDF, MissingValues = ReadData(os.path.join(REPO_DIR, fileName))
+        cases[station] = ClipData(DataDF, *GOLDEN_PERIOD)[0]
+    cases['edge cases'] = MakeEdgeCases()
+    expected = {(name, period): ReferenceStatistics(DataDF, period)
+                for name, DataDF in cases.items() for period in PERIOD_RULES}
+    report = {'ok': True}
+    previous = metric_engine.BACKEND
+    try:
+        for backend in sorted(metric_engine.BACKENDS):
+            metric_engine.SetBackend(backend)
+            error = 0.0
+            for (name, period), reference in expected.items():
+                table = CalcPeriodMetrics(cases[name], period, METRICS)
+                if not table.index.equals(reference.index):
+                    error = float('inf')
+                    continue
+                error = max(error, CompareTables(table, reference,
+                                                 BACKEND_RTOL))
+            report[backend] = error
+            if error > BACKEND_RTOL:
+                report['ok'] = False
+    finally:
+        metric_engine.SetBackend(previous)
+    return( report )
+
+
+def RunStages(fileNames, period):
+    """This function runs the pipeline stage by stage over all files and
+    returns the wall time of every stage and the final row counts."""
+    times = {}
+    rows = {}
+
+    def timed(stage, func, inputs):
+        start = time.perf_counter()
+        outputs = [func(x) for x in inputs]
+        times[stage] = time.perf_counter() - start
+        return( outputs )
+
+    raw = timed('ReadData', ReadData, fileNames)
+    rows['ReadData'] = sum(len(d) for d, m in raw)
+    clipped = timed('ClipData', lambda r: ClipData(r[0], *period), raw)
+    rows['ClipData'] = sum(len(d) for d, m in clipped)
+    annual = timed('GetAnnualStatistics', lambda c: GetAnnualStatistics(c[0]),
+                   clipped)
+    rows['GetAnnualStatistics'] = sum(len(t) for t in annual)
+    monthly = timed('GetMonthlyStatistics',
+                    lambda c: GetMonthlyStatistics(c[0]), clipped)
+    rows['GetMonthlyStatistics'] = sum(len(t) for t in monthly)
+    timed('GetAnnualAverages', GetAnnualAverages, annual)
+    rows['GetAnnualAverages'] = len(annual)
+    timed('GetMonthlyAverages', GetMonthlyAverages, monthly)
+    rows['GetMonthlyAverages'] = len(monthly)
+    return( times, rows )
+
+
+def MeasurePeaks(fileNames, period):
+    """This function returns the peak traced memory, in bytes, of every
+    stage run over all files."""
+    peaks = {}
+
+    def traced(stage, func, inputs):
+        tracemalloc.start()
+        outputs = [func(x) for x in inputs]
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return( outputs )
+
+    raw = traced('ReadData', ReadData, fileNames)
+    clipped = traced('ClipData', lambda r: ClipData(r[0], *period), raw)
+    annual = traced('GetAnnualStatistics',
+                    lambda c: GetAnnualStatistics(c[0]), clipped)
+    monthly = traced('GetMonthlyStatistics',
+                     lambda c: GetMonthlyStatistics(c[0]), clipped)
+    traced('GetAnnualAverages', GetAnnualAverages, annual)
+    traced('GetMonthlyAverages', GetMonthlyAverages, monthly)
+    return( peaks )
+
+
+def RunBenchmark(sites=10, years=60, repeat=5, workDir=None, seed=0,
+                 backend=None):
+    """This function writes the synthetic files, checks the golden outputs
+    and the backends, and times every stage with the given metric engine
+    backend (by default the active one).  The routine returns the result
+    dictionary that is written as JSON; each stage keeps the best wall time
+    of the repeats."""
+    previous = metric_engine.BACKEND
+    if backend is not None:
+        metric_engine.SetBackend(backend)
+    ownDir = workDir is None
+    if ownDir:
+        tmp = tempfile.TemporaryDirectory()
+        workDir = tmp.name
+    try:
+        fileNames = []
+        for i in range(sites):
+            fileName = os.path.join(workDir, 'Synthetic_{:02d}.txt'.format(i))
+            WriteSyntheticRDB(fileName, '{:08d}'.format(3300000 + i),
+                              years=years, seed=seed + i)
+            fileNames.append(fileName)
+        period = ('1955-10-01', '{}-09-30'.format(1950 + years - 1))
+
+        result = {'meta': {'python': platform.python_version(),
+                           'numpy': np.__version__,
+                           'pandas': pd.__version__,
+                           'machine': platform.machine(),
+                           'sites': sites, 'years': years,
+                           'repeat': repeat, 'seed': seed,
+                           'backend': metric_engine.BACKEND,
+                           'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                  'golden': CheckGolden(),
+                  'backends': CheckBackends(),
+                  'stages': {}}
+        runs = []
+        for i in range(repeat):
+            times, rows = RunStages(fileNames, period)
+            runs.append(times)
+        peaks = MeasurePeaks(fileNames, period)
+        for stage in runs[0]:
+            wall = [run[stage] for run in runs]
+            result['stages'][stage] = {'wall_s': min(wall), 'wall_s_all': wall,
+                                       'peak_bytes': peaks[stage],
+                                       'rows': rows[stage]}
+    finally:
+        metric_engine.SetBackend(previous)
+        if ownDir:
+            tmp.cleanup()
+    return( result )
+
+
+def CompareResults(result, baseline, threshold=0.25):
+    """This function compares the best wall time of every stage with a
+    baseline result.  The routine returns the list of (stage, baseline,
+    new, ratio) tuples of the stages slower than 1 + threshold times the
+    baseline.  A ValueError is raised when the run settings in
+    COMPARED_META differ from those recorded in the baseline."""
+    meta = result['meta']
+    if 'meta' not in baseline:
+        raise ValueError("the baseline has no run settings")
+    # settings missing from older baselines are not compared
+    oldMeta = baseline['meta']
+    differ = ['{} {} vs {}'.format(name, oldMeta[name], meta.get(name))
+              for name in COMPARED_META
+              if name in oldMeta and oldMeta[name] != meta.get(name)]
+    if differ:
+        raise ValueError("the baseline was run with other settings ({}), "
+                         "rerun it with the same ones".format(
+                             ', '.join(differ)))
+    slower = []
+    for stage, new in result['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is None or old['wall_s'] <= 0:
+            continue
+        ratio = new['wall_s']/old['wall_s']
+        if ratio > 1 + threshold:
+            slower.append((stage, old['wall_s'], new['wall_s'], ratio))
+    return( slower )
+
+
+def main(argv=None):
+    """Command line entry of the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sites', type=int, default=10)
+    parser.add_argument('--years', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the synthetic files here')
+    parser.add_argument('--output', default='benchmark_10.json')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown per stage')
+    parser.add_argument('--backend', default=None,
+                        help='metric engine backend to time, numpy or numba')
+    args = parser.parse_args(argv)
+    if args.backend is not None:
+        try:
+            metric_engine.GetBackend(args.backend)
+        except (ValueError, ImportError) as error:
+            parser.error(str(error))
+
+    result = RunBenchmark(args.sites, args.years, args.repeat, args.work_dir,
+                          args.seed, args.backend)
+    status = 0
+    golden = result['golden']
+    print("golden outputs: {} (annual {:.3g}, monthly {:.3g})".format(
+        'ok' if golden['ok'] else 'MISMATCH', golden['annual'],
+        golden['monthly']))
+    if not golden['ok']:
+        status = 1
+    backends = result['backends']
+    print("backends: {} ({})".format(
+        'ok' if backends['ok'] else 'MISMATCH',
+        ', '.join('{} {:.3g}'.format(name, error)
+                  for name, error in backends.items() if name != 'ok')))
+    if not backends['ok']:
+        status = 1
+    for stage, values in result['stages'].items():
+        print("{:<22s} {:9.4f} s {:10.1f} MiB {:10d} rows".format(
+            stage, values['wall_s'], values['peak_bytes']/2**20,
+            values['rows']))
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        try:
+            slower = CompareResults(result, baseline, args.threshold)
+        except ValueError as error:
+            print("cannot compare with {}: {}".format(args.baseline, error),
+                  file=sys.stderr)
+            slower = []
+            status = 1
+            result['baseline_error'] = str(error)
+        result['slower'] = [dict(zip(('stage', 'baseline_s', 'wall_s',
+                                      'ratio'), s)) for s in slower]
+        for stage, old, new, ratio in slower:
+            print("SLOWER {}: {:.4f} s -> {:.4f} s ({:.2f}x)".format(
+                stage, old, new, ratio))
+        if slower:
+            status = 1
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    return( status )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/bin/env python
+"""
+Flow duration curves and exceedance queries for the program_10 periods.
+
+The valid discharge of each water year, month or of the whole record is
+sorted once, with the same sorted segments the metric engine takes the
+Median Flow and 3xMedian from.  Any number of percentile (Q10, Q50, Q95,
+...) and threshold count queries are then answered from the sorted
+segments by interpolation and bisection, without sorting or scanning the
+data again.
+
+    curves = FlowDuration.FromFrame(DataDF, 'WY')
+    curves.Curve([10, 50, 90, 95])      # flows exceeded 10%..95% of the time
+    curves.CountAbove(1000.0)           # days above 1000 cfs in each year
+"""
+import numpy as np
+import pandas as pd
+
+from metric_engine import (GetPeriodCodes, SegmentData, SegmentMedian,
+                           SegmentPercentile, SegmentSearch)
+
+# exceedance percents of the default flow duration curve
+CURVE_PERCENTS = [5, 10, 25, 50, 75, 90, 95]
+
+
+class FlowDuration(object):
+    """Discharge of every period sorted within the period."""
+
+    def __init__(self, sortedValues, offsets, index):
+        self.sortedValues = sortedValues
+        self.offsets = offsets
+        self.index = index
+
+    @classmethod
+    def FromSegments(cls, data, index):
+        """This function builds the curves from the sorted segments of a
+        metric_engine SegmentData, sorting them if no metric did yet."""
+        return( cls(data['sorted'], data['offsets'], index) )
+
+    @classmethod
+    def FromFrame(cls, DataDF, period='WY'):
+        """This function builds the curves of every water year ('WY'),
+        month ('M') or of the whole record (None) of a streamflow DataFrame
+        indexed by date.  NoData values are left out."""
+        dates = DataDF.index
+        values = DataDF['Discharge'].to_numpy(dtype=np.float64,
+                                              na_value=np.nan)
+        if not dates.is_monotonic_increasing:
+            order = np.argsort(dates.values, kind='stable')
+            dates = dates[order]
+            values = values[order]
+        if period is None:
+            codes = np.zeros(len(dates), dtype=np.int64)
+            index = pd.DatetimeIndex(dates[:1], name='Date')
+        else:
+            codes, index = GetPeriodCodes(dates, period)
+        return( cls.FromSegments(SegmentData(values, codes, len(index)),
+                                 index) )
+
+    @property
+    def counts(self):
+        """Number of valid values of every period."""
+        return( pd.Series(np.diff(self.offsets), index=self.index) )
+
+    def Percentile(self, percent):
+        """This function returns the given percentile (0 to 100) of every
+        period, interpolated as numpy.percentile."""
+        return( pd.Series(SegmentPercentile(self.sortedValues, self.offsets,
+                                            percent), index=self.index) )
+
+    def Median(self):
+        """This function returns the median flow of every period."""
+        return( pd.Series(SegmentMedian(self.sortedValues, self.offsets),
+                          index=self.index) )
+
+    def Exceedance(self, percent):
+        """This function returns the flow equalled or exceeded percent of
+        the time in every period (Q<percent>)."""
+        return( self.Percentile(100 - percent) )
+
+    def Curve(self, percents=CURVE_PERCENTS):
+        """This function returns the flow duration curve of every period: a
+        DataFrame with one 'Q<percent>' column per exceedance percent."""
+        return( pd.DataFrame({'Q{:g}'.format(p): self.Exceedance(p).values
+                              for p in percents}, index=self.index) )
+
+    def CountAbove(self, threshold):
+        """This function returns the number of days of every period with a
+        flow above threshold, a scalar or one value per period."""
+        above = self.offsets[1:] - SegmentSearch(
+            self.sortedValues, self.offsets, threshold, side='right')
+        return( pd.Series(above, index=self.index) )
+
+    def CountBelow(self, threshold):
+        """This function returns the number of days of every period with a
+        flow below threshold, a scalar or one value per period."""
+        below = SegmentSearch(self.sortedValues, self.offsets, threshold,
+                              side='left') - self.offsets[:-1]
+        return( pd.Series(below, index=self.index) )
+
+    def ExceedanceFraction(self, threshold):
+        """This function returns the fraction of the days of every period
+        with a flow above threshold, NaN for periods without valid data."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return( self.CountAbove(threshold)/self.counts )
@@ -0,0 +1,258 @@
+#!/bin/env python
+"""
+Incremental update of the metrics of a site as new daily values arrive.
+
+The state of a site is kept in a .npz file: the metric rows of every
+closed water year and month, the running sums and counts behind the annual
+and monthly averages, and the rows of the water year and month that are
+still open.  The open rows are the sufficient statistics of the open
+periods, since the median, Tqmean and 3xMedian need every value of their
+period while the count, sums, 7-day window and previous value for R-B
+index are all derived from them.  Appending new rows only recomputes the
+open month and water year and the averages are updated from the sums, so
+the history is never scanned again.  The dates and discharges appended in
+the open water year are kept as well, so a re-downloaded record whose
+values there were revised (USGS provisional data) is caught instead of
+silently ignored.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from metric_engine import GetPeriodKeys, GetPeriodStarts
+from program_10 import ANNUAL_COLUMNS, MONTHLY_COLUMNS, ReadData
+from streaming_metrics import PeriodStream
+
+# bump when the layout of the state file changes
+STATE_VERSION = 2
+
+# period and columns of the two tables kept for a site
+TABLES = {'annual': ('WY', ANNUAL_COLUMNS),
+          'monthly': ('M', MONTHLY_COLUMNS)}
+
+
+class IncrementalSite(object):
+    """Metric tables of one site that can be extended with new rows.  Rows
+    outside startDate..endDate are ignored, like ClipData does."""
+
+    def __init__(self, startDate=None, endDate=None):
+        self.startDate = startDate
+        self.endDate = endDate
+        self.lastDate = None
+        # rows appended in the open water year, to check re-downloads
+        self.openDates = np.empty(0, dtype='datetime64[ns]')
+        self.openDischarge = np.empty(0)
+        self.streams = {}
+        self.closed = {}
+        self.sums = {}
+        self.counts = {}
+        for name, (period, colname) in TABLES.items():
+            self.streams[name] = PeriodStream(period, colname, startDate,
+                                              endDate)
+            self.closed[name] = self.streams[name].Empty()
+            # annual sums are one row, monthly sums one row per calendar month
+            shape = (1 if period == 'WY' else 12, len(colname))
+            self.sums[name] = np.zeros(shape)
+            self.counts[name] = np.zeros(shape, dtype=np.int64)
+
+    def Append(self, DataDF):
+        """This function adds the rows of DataDF dated after the last row
+        seen so far.  Earlier rows, as in a re-downloaded full record, are
+        skipped once CheckRevisions has found those of the open water year
+        unchanged; revisions of closed water years are not detected.  Only
+        the open month and water year are recomputed."""
+        if self.lastDate is not None:
+            self.CheckRevisions(DataDF[DataDF.index <= self.lastDate])
+            DataDF = DataDF[DataDF.index > self.lastDate]
+        if len(DataDF) == 0:
+            return
+        for name, stream in self.streams.items():
+            done = stream.Push(DataDF)
+            if len(done):
+                self.closed[name] = pd.concat([self.closed[name], done])
+                self.AddToSums(name, done)
+        self.lastDate = DataDF.index.max()
+        # keep the rows of the water year of the last row
+        openStart = GetPeriodStarts(GetPeriodKeys([self.lastDate], 'WY')[0],
+                                    1, 'WY')[0]
+        dates = np.concatenate([self.openDates,
+                                DataDF.index.values.astype('datetime64[ns]')])
+        discharge = np.concatenate([self.openDischarge, DataDF[
+            'Discharge'].to_numpy(dtype=np.float64, na_value=np.nan)])
+        keep = dates >= openStart.to_datetime64()
+        self.openDates = dates[keep]
+        self.openDischarge = discharge[keep]
+
+    def CheckRevisions(self, DataDF):
+        """This function compares rows already appended with the rows of
+        the open water year kept from the earlier appends, and raises a
+        ValueError when a discharge differs or a row was added or removed,
+        since the metrics of the open periods would no longer match the
+        record.  Rebuild the state from the full record in that case."""
+        if len(self.openDates) == 0:
+            return
+        dates = DataDF.index.values.astype('datetime64[ns]')
+        inOpen = dates >= self.openDates[0]
+        dates = dates[inOpen]
+        discharge = DataDF['Discharge'].to_numpy(
+            dtype=np.float64, na_value=np.nan)[inOpen]
+        if len(dates) == 0:
+            return
+        # the record may start inside the open water year
+        stored = self.openDates >= dates[0]
+        if not (np.array_equal(dates, self.openDates[stored]) and
+                np.array_equal(discharge, self.openDischarge[stored],
+                               equal_nan=True)):
+            raise ValueError("rows on or before {} differ from the rows "
+                             "appended before (revised values?), rebuild "
+                             "the state from the full record".format(
+                                 self.lastDate.date()))
+
+    def AppendFile(self, fileName, cache=None):
+        """This function reads an RDB file with ReadData and appends its
+        new rows."""
+        DataDF, MissingValues = ReadData(fileName, columns=['site_no'],
+                                         cache=cache)
+        self.Append(DataDF)
+
+    def AddToSums(self, name, table):
+        """This function adds the rows of a closed metrics table to the
+        running sums of the averages."""
+        values = table.to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        if self.sums[name].shape[0] == 1:
+            rows = np.zeros(len(table), dtype=np.int64)
+        else:
+            rows = table.index.month.values - 1
+        np.add.at(self.sums[name], rows, np.where(valid, values, 0.0))
+        np.add.at(self.counts[name], rows, valid)
+
+    def GetStatistics(self, name):
+        """This function returns the full 'annual' or 'monthly' metrics
+        table, the open period included."""
+        return( pd.concat([self.closed[name],
+                           self.streams[name].Current()]) )
+
+    def GetAnnualStatistics(self):
+        """This function returns the water year metrics table, laid out as
+        program_10.GetAnnualStatistics returns it."""
+        return( self.GetStatistics('annual') )
+
+    def GetMonthlyStatistics(self):
+        """This function returns the monthly metrics table, laid out as
+        program_10.GetMonthlyStatistics returns it."""
+        return( self.GetStatistics('monthly') )
+
+    def GetAverages(self, name):
+        """This function returns the averages of a table from the running
+        sums, with the open period added in."""
+        sums = self.sums[name].copy()
+        counts = self.counts[name].copy()
+        current = self.streams[name].Current()
+        if len(current):
+            values = current.to_numpy(dtype=np.float64)
+            valid = ~np.isnan(values)
+            row = 0 if sums.shape[0] == 1 else current.index.month[0] - 1
+            sums[row] += np.where(valid, values, 0.0)[0]
+            counts[row] += valid[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return( sums/counts )
+
+    def GetAnnualAverages(self):
+        """This function returns the annual averages, as
+        program_10.GetAnnualAverages does."""
+        return( pd.Series(self.GetAverages('annual')[0],
+                          index=ANNUAL_COLUMNS) )
+
+    def GetMonthlyAverages(self):
+        """This function returns the average of every calendar month, one
+        row per month (1-12)."""
+        return( pd.DataFrame(self.GetAverages('monthly'),
+                             index=pd.Index(np.arange(1, 13), name='Month'),
+                             columns=MONTHLY_COLUMNS) )
+
+    def Save(self, stateFile):
+        """This function writes the state of the site to a .npz file.  The
+        file is written under a temporary name and then swapped in, so a
+        crash mid-write leaves the previous state intact."""
+        state = {'version': STATE_VERSION,
+                 'startDate': str(self.startDate or ''),
+                 'endDate': str(self.endDate or ''),
+                 'lastDate': str(self.lastDate or ''),
+                 'open.dates': self.openDates,
+                 'open.discharge': self.openDischarge}
+        for name, stream in self.streams.items():
+            state[name + '.keys'] = stream.keys
+            state[name + '.discharge'] = stream.discharge
+            state[name + '.site'] = stream.site
+            state[name + '.nextKey'] = -1 if stream.nextKey is None \
+                else stream.nextKey
+            state[name + '.missing'] = stream.missingValues
+            state[name + '.values'] = self.closed[name].to_numpy(
+                dtype=np.float64)
+            state[name + '.index'] = self.closed[name].index.values.astype(
+                'datetime64[ns]')
+            state[name + '.sums'] = self.sums[name]
+            state[name + '.counts'] = self.counts[name]
+        handle, tmpFile = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(stateFile)), prefix='.tmp',
+            suffix='.npz')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **state)
+            os.replace(tmpFile, stateFile)
+        except BaseException:
+            os.remove(tmpFile)
+            raise
+
+    @classmethod
+    def Load(cls, stateFile):
+        """This function reads the state of a site written by Save."""
+        with np.load(stateFile, allow_pickle=False) as state:
+            if int(state['version']) != STATE_VERSION:
+                raise ValueError("{} has state version {}, expected {}".format(
+                    stateFile, int(state['version']), STATE_VERSION))
+            site = cls(str(state['startDate']) or None,
+                       str(state['endDate']) or None)
+            lastDate = str(state['lastDate'])
+            site.lastDate = pd.Timestamp(lastDate) if lastDate else None
+            site.openDates = state['open.dates']
+            site.openDischarge = state['open.discharge']
+            for name, stream in site.streams.items():
+                stream.keys = state[name + '.keys']
+                stream.discharge = state[name + '.discharge']
+                stream.site = state[name + '.site']
+                nextKey = int(state[name + '.nextKey'])
+                stream.nextKey = None if nextKey < 0 else nextKey
+                stream.missingValues = int(state[name + '.missing'])
+                site.closed[name] = pd.DataFrame(
+                    state[name + '.values'], columns=stream.colname,
+                    index=pd.DatetimeIndex(state[name + '.index'],
+                                           name='Date'))
+                site.sums[name] = state[name + '.sums']
+                site.counts[name] = state[name + '.counts']
+        return( site )
+
+
+def UpdateSite(stateFile, fileName, startDate=None, endDate=None,
+               cache=None):
+    """This function appends the new rows of an RDB file to the state kept
+    in stateFile, creating it on the first call, and returns the updated
+    IncrementalSite.  A ValueError is raised when startDate or endDate is
+    given and differs from the one the state was created with."""
+    try:
+        site = IncrementalSite.Load(stateFile)
+    except FileNotFoundError:
+        site = IncrementalSite(startDate, endDate)
+    for name, given, stored in [('startDate', startDate, site.startDate),
+                                ('endDate', endDate, site.endDate)]:
+        if given is not None and (stored is None or
+                                  pd.Timestamp(given) != pd.Timestamp(stored)):
+            raise ValueError("{} was created with {} {}, not {}; rebuild "
+                             "it to change the period".format(
+                                 stateFile, name, stored, given))
+    site.AppendFile(fileName, cache)
+    site.Save(stateFile)
+    return( site )
@@ -0,0 +1,149 @@
+#!/bin/env python
+"""
+Opt-in timing instrumentation for the program_10 pipeline.
+
+The pipeline functions mark their work with Stage(name) blocks.  While no
+Instrument() block is active, Stage returns one shared do-nothing object,
+so the marks cost a function call each.  Inside an Instrument() block every
+stage records its wall time, row count and, when memory tracing is on, the
+tracemalloc memory delta and peak, tagged with the current site; the
+collected records are returned as a plain dictionary ready for JSON.  A
+cProfile profile of the whole block can be taken at the same time.
+
+    with Instrument(site='Wildcat', traceMemory=True) as recorder:
+        DataDF, MissingValues = ReadData(fileName)
+        ...
+    json.dump(recorder.Report(), f)
+"""
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# recorder of the active Instrument block, None when instrumentation is off
+_recorder = None
+
+
+class NullStage(object):
+    """Stand-in returned by Stage while instrumentation is off."""
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return( self )
+
+    def __exit__(self, *exc):
+        return( False )
+
+
+_NULL_STAGE = NullStage()
+
+
+class StageTimer(object):
+    """Times one stage for a Recorder.  Set rows inside the block to record
+    how many rows the stage handled."""
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        stack = self.recorder.Stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        if self.recorder.traceMemory:
+            self.memStart = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return( self )
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        record = {'site': self.recorder.site, 'stage': self.name,
+                  'parent': self.parent, 'wall_s': wall, 'rows': self.rows}
+        if self.recorder.traceMemory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['mem_delta_bytes'] = current - self.memStart
+            record['mem_peak_bytes'] = peak
+        self.recorder.Stack().pop()
+        self.recorder.records.append(record)
+        return( False )
+
+
+class Recorder(object):
+    """Collects the stage records of an Instrument block."""
+
+    def __init__(self, site=None, traceMemory=False):
+        self.site = site
+        self.traceMemory = traceMemory
+        self.records = []
+        self.profile = None
+        self.local = threading.local()
+
+    def Stack(self):
+        """This function returns the stack of open stages of the calling
+        thread."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return( self.local.stack )
+
+    def Report(self, profileLines=25):
+        """This function returns the records as a dictionary: the list of
+        stage records, totals (calls, wall time, rows) per site and stage,
+        and the top profileLines entries of the cProfile report when
+        profiling was on."""
+        totals = {}
+        for record in self.records:
+            site = str(record['site'])
+            total = totals.setdefault(site, {}).setdefault(
+                record['stage'], {'calls': 0, 'wall_s': 0.0, 'rows': 0})
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['rows'] += record['rows'] or 0
+        report = {'stages': self.records, 'totals': totals}
+        if self.profile is not None:
+            text = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=text)
+            stats.sort_stats('cumulative').print_stats(profileLines)
+            report['profile'] = text.getvalue()
+        return( report )
+
+
+def Stage(name):
+    """This function returns the context manager that times a stage, or a
+    shared do-nothing one while instrumentation is off."""
+    if _recorder is None:
+        return( _NULL_STAGE )
+    return( StageTimer(_recorder, name) )
+
+
+@contextmanager
+def Instrument(site=None, traceMemory=False, profile=False,
+               profileFile=None):
+    """This function turns instrumentation on for the duration of a with
+    block and yields its Recorder.  traceMemory records tracemalloc memory
+    deltas per stage (tracemalloc slows the run down), profile runs
+    cProfile over the block, and profileFile also dumps the profile there
+    for pstats/snakeviz."""
+    global _recorder
+    previous = _recorder
+    recorder = Recorder(site, traceMemory)
+    startedTracing = traceMemory and not tracemalloc.is_tracing()
+    if startedTracing:
+        tracemalloc.start()
+    if profile or profileFile is not None:
+        recorder.profile = cProfile.Profile()
+        recorder.profile.enable()
+    _recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+        if recorder.profile is not None:
+            recorder.profile.disable()
+            if profileFile is not None:
+                recorder.profile.dump_stats(profileFile)
+        if startedTracing:
+            tracemalloc.stop()
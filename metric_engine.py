@@ -0,0 +1,399 @@
+#!/bin/env python
+"""
+Vectorized metric engine for the streamflow statistics in program_10.
+
+All water years (or months) of a discharge series are handled in one pass.
+Rows are tagged with an integer period code, the codes give the offsets of
+each period segment, and every metric is computed with NumPy segment
+reductions over those offsets instead of one Python call per period.  The
+results follow the NoData rules of the CalcTqmean, CalcRBindex, Calc7Q and
+CalcExceed3TimesMedian functions in program_10.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import Stage
+
+# metrics of program_10, in its column order; more are in METRIC_REGISTRY
+METRICS = ['Mean Flow', 'Peak Flow', 'Median Flow', 'Coeff Var', 'Skew',
+           'Tqmean', 'R-B index', '7Q', '3xMedian']
+
+# offsets used to label the periods, same labels as resample('AS-OCT'/'MS')
+PERIOD_OFFSETS = {'WY': pd.offsets.YearBegin(month=10),
+                  'M': pd.offsets.MonthBegin()}
+
+
+def GetPeriodKeys(dates, period):
+    """This function tags every date with an absolute integer period key.
+    period is 'WY' for water years starting on October 1, keyed by the
+    calendar year in which they end, or 'M' for calendar months, keyed by
+    year*12 + month - 1.  Consecutive periods have consecutive keys."""
+    dates = pd.DatetimeIndex(dates)
+    year = dates.year.values.astype(np.int64)
+    month = dates.month.values.astype(np.int64)
+    if period == 'WY':
+        return( year + (month >= 10) )
+    if period == 'M':
+        return( year*12 + month - 1 )
+    raise ValueError("period must be 'WY' or 'M', not {!r}".format(period))
+
+
+def GetPeriodStarts(firstKey, nPeriods, period):
+    """This function returns the DatetimeIndex of the start dates of
+    nPeriods consecutive periods, starting with the period of firstKey."""
+    if period == 'WY':
+        start = pd.Timestamp(int(firstKey) - 1, 10, 1)
+    else:
+        start = pd.Timestamp(int(firstKey)//12, int(firstKey) % 12 + 1, 1)
+    return( pd.date_range(start, periods=int(nPeriods),
+                          freq=PERIOD_OFFSETS[period], name='Date') )
+
+
+def GetPeriodCodes(dates, period):
+    """This function tags every date with an integer period code counted
+    from the first period of the record.  period is 'WY' or 'M' as in
+    GetPeriodKeys.  The routine returns the code array and the
+    DatetimeIndex of the period start dates, which covers every period
+    between the first and the last date."""
+    key = GetPeriodKeys(dates, period)
+    if len(key) == 0:
+        return( key, pd.DatetimeIndex([], name='Date') )
+    first = key.min()
+    codes = key - first
+    return( codes, GetPeriodStarts(first, codes.max() + 1, period) )
+
+
+def GetSegmentOffsets(codes, nPeriods):
+    """This function returns the nPeriods+1 offsets that bound each period
+    segment in a sorted array of period codes.  Empty periods give two
+    equal offsets."""
+    return( np.searchsorted(codes, np.arange(nPeriods + 1)) )
+
+
+def SegmentReduce(ufunc, values, offsets, empty=np.nan):
+    """This function applies ufunc.reduceat over the segments of values
+    defined by offsets.  Empty segments are filled with the empty value."""
+    counts = np.diff(offsets)
+    out = np.full(len(counts), empty, dtype=np.float64)
+    nonEmpty = counts > 0
+    if nonEmpty.any():
+        out[nonEmpty] = ufunc.reduceat(values, offsets[:-1][nonEmpty])
+    return( out )
+
+
+def SegmentSort(values, codes):
+    """This function sorts values within each period segment, keeping the
+    segments in code order.  codes must be sorted."""
+    return( values[np.lexsort((values, codes))] )
+
+
+def SegmentMedian(sortedValues, offsets):
+    """This function picks the median of every segment of an array that is
+    sorted within segments.  Empty segments give NaN."""
+    counts = np.diff(offsets)
+    out = np.full(len(counts), np.nan)
+    nonEmpty = counts > 0
+    lo = offsets[:-1][nonEmpty] + (counts[nonEmpty] - 1)//2
+    hi = offsets[:-1][nonEmpty] + counts[nonEmpty]//2
+    out[nonEmpty] = (sortedValues[lo] + sortedValues[hi])/2
+    return( out )
+
+
+def SegmentRollingMin(values, codes, nPeriods, window):
+    """This function computes the lowest window-length moving average in
+    every segment.  Only windows that lie inside a single segment count, so
+    segments shorter than the window give NaN."""
+    nWin = len(values) - window + 1
+    if nWin <= 0:
+        return( np.full(nPeriods, np.nan) )
+    # sum of the shifted slices gives every window sum without a rolling object
+    winSum = values[:nWin].copy()
+    for k in range(1, window):
+        winSum += values[k:k + nWin]
+    inside = codes[:nWin] == codes[window - 1:]
+    winMean = winSum[inside]/window
+    winOffsets = GetSegmentOffsets(codes[:nWin][inside], nPeriods)
+    return( SegmentReduce(np.minimum, winMean, winOffsets) )
+
+
+def SegmentPercentile(sortedValues, offsets, percent):
+    """This function interpolates the given percentile (0 to 100) of every
+    segment of an array that is sorted within segments, the same way as
+    numpy.percentile.  Empty segments give NaN."""
+    counts = np.diff(offsets)
+    out = np.full(len(counts), np.nan)
+    nonEmpty = counts > 0
+    pos = offsets[:-1][nonEmpty] + (counts[nonEmpty] - 1)*percent/100.0
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    out[nonEmpty] = sortedValues[lo] + (sortedValues[hi] -
+                                        sortedValues[lo])*(pos - lo)
+    return( out )
+
+
+def SegmentSearch(sortedValues, offsets, threshold, side='left'):
+    """This function finds, in every segment of an array that is sorted
+    within segments, the position at which the threshold of the segment
+    (a scalar or one value per segment) would be inserted, as
+    numpy.searchsorted does on the segment alone.  All segments are
+    searched together by bisection.  The routine returns the positions in
+    the whole array."""
+    lo = offsets[:-1].copy()
+    hi = offsets[1:].copy()
+    threshold = np.broadcast_to(threshold, lo.shape)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi)//2
+        value = sortedValues[np.minimum(mid, len(sortedValues) - 1)]
+        if side == 'right':
+            right = value <= threshold
+        else:
+            right = value < threshold
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return( lo )
+
+
+class SegmentData(object):
+    """Intermediate arrays shared by the metrics of one segmented discharge
+    array.  Each intermediate registered in INTERMEDIATES is computed once,
+    on first use, and kept for the other metrics, in an
+    'intermediate:<name>' instrumentation stage of its own.  The active
+    backend may compute some of them in its own way."""
+
+    def __init__(self, values, codes, nPeriods):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.nPeriods = nPeriods
+        self.cache = {}
+        self.lookup = GetBackend()
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            entry = None if self.lookup is None else self.lookup(name)
+            needs, func = entry or INTERMEDIATES[name]
+            for need in needs:
+                self[need]
+            with Stage('intermediate:' + name) as stage:
+                self.cache[name] = func(self)
+                stage.rows = len(self.values)
+        return( self.cache[name] )
+
+
+# intermediate name -> (names it needs, function of the SegmentData)
+INTERMEDIATES = {}
+
+# metric name -> (intermediates it needs, function of the SegmentData)
+METRIC_REGISTRY = {}
+
+# backend name -> function giving the (needs, function) of the intermediates
+# the backend computes itself, or None; 'numpy' uses INTERMEDIATES only
+BACKENDS = {'numpy': None}
+
+# backend of new SegmentData objects, see SetBackend
+BACKEND = os.environ.get('STREAMFLOW_BACKEND', 'numpy')
+
+
+def RegisterBackend(name, lookup):
+    """This function registers a backend.  lookup(name) returns the
+    (needs, function) pair of an intermediate the backend computes in place
+    of the one in INTERMEDIATES, or None to use the registered one."""
+    BACKENDS[name] = lookup
+
+
+def GetBackend(name=None):
+    """This function returns the lookup of the named backend, by default
+    the active one.  The compiled 'numba' backend is loaded on first use
+    and needs numba installed."""
+    name = BACKEND if name is None else name
+    if name not in BACKENDS:
+        # the compiled kernels register themselves when numba is installed
+        import metric_kernels
+    if name == 'numba' and name not in BACKENDS:
+        raise ImportError("the numba backend needs numba, install it or use "
+                          "the numpy backend")
+    if name not in BACKENDS:
+        raise ValueError("unknown backend {!r}, use one of {}".format(
+            name, ', '.join(sorted(BACKENDS))))
+    return( BACKENDS[name] )
+
+
+def SetBackend(name):
+    """This function selects the backend computing the intermediates of
+    the metrics: 'numpy' or 'numba'.  The STREAMFLOW_BACKEND environment
+    variable gives the backend at start up."""
+    global BACKEND
+    GetBackend(name)
+    BACKEND = name
+
+
+def RegisterIntermediate(name, needs, func):
+    """This function registers an intermediate array computed by
+    func(data) from the intermediates listed in needs."""
+    INTERMEDIATES[name] = (list(needs), func)
+
+
+def RegisterMetric(name, needs, func):
+    """This function registers a metric computed by func(data), where data
+    is a SegmentData, from the intermediates listed in needs.  func returns
+    one value per period.  Registered metrics can be asked for by name in
+    the colname lists of CalcColumnMetrics and CalcPeriodMetrics."""
+    METRIC_REGISTRY[name] = (list(needs), func)
+
+
+def RegisterRollingMin(window):
+    """This function registers the lowest window-day moving average of each
+    period as the intermediate 'rolling min <window>' and returns its
+    name."""
+    name = 'rolling min {}'.format(window)
+    RegisterIntermediate(name, ['q', 'g'], lambda s: SegmentRollingMin(
+        s['q'], s['g'], s.nPeriods, window))
+    return( name )
+
+
+def RegisterFlowDuration(percent):
+    """This function registers the flow equalled or exceeded percent of the
+    time in each period (the flow duration curve) as the metric
+    'Q<percent>' and returns its name."""
+    name = 'Q{:g}'.format(percent)
+    RegisterMetric(name, ['sorted', 'offsets'], lambda s: SegmentPercentile(
+        s['sorted'], s['offsets'], 100 - percent))
+    return( name )
+
+
+def CalcSkew(s):
+    """This function returns the biased sample skewness of each period, as
+    scipy.stats.skew, NaN for periods holding a NoData value."""
+    m2 = s['m2Sum']/s['n']
+    m3 = s['m3Sum']/s['n']
+    skew = m3/m2**1.5
+    zero = m2 <= (np.finfo(np.float64).resolution*s['mean'])**2
+    skew[zero | (s['nanCount'] > 0) | (s['n'] == 0)] = np.nan
+    return( skew )
+
+
+# the shared intermediates: valid values and codes, segment sums and moments
+RegisterIntermediate('isNaN', [], lambda s: np.isnan(s.values))
+RegisterIntermediate('nanCount', ['isNaN'], lambda s: np.bincount(
+    s.codes[s['isNaN']], minlength=s.nPeriods))
+RegisterIntermediate('q', ['isNaN'], lambda s: s.values[~s['isNaN']])
+RegisterIntermediate('g', ['isNaN'], lambda s: s.codes[~s['isNaN']])
+RegisterIntermediate('offsets', ['g'], lambda s: GetSegmentOffsets(
+    s['g'], s.nPeriods))
+RegisterIntermediate('n', ['offsets'], lambda s: np.diff(s['offsets']))
+RegisterIntermediate('total', ['q', 'offsets'], lambda s: SegmentReduce(
+    np.add, s['q'], s['offsets'], empty=0.0))
+RegisterIntermediate('mean', ['total', 'n'], lambda s: s['total']/s['n'])
+RegisterIntermediate('dev', ['q', 'mean', 'n'], lambda s: s['q'] -
+                     np.repeat(s['mean'], s['n']))
+RegisterIntermediate('m2Sum', ['dev', 'offsets'], lambda s: SegmentReduce(
+    np.add, s['dev']**2, s['offsets'], empty=0.0))
+RegisterIntermediate('m3Sum', ['dev', 'offsets'], lambda s: SegmentReduce(
+    np.add, s['dev']**3, s['offsets'], empty=0.0))
+# day-to-day changes that stay inside one period, and their sum
+RegisterIntermediate('same', ['g'], lambda s: s['g'][1:] == s['g'][:-1])
+RegisterIntermediate('path', ['q', 'g', 'same'], lambda s: np.bincount(
+    s['g'][1:][s['same']], weights=np.abs(np.diff(s['q']))[s['same']],
+    minlength=s.nPeriods))
+RegisterIntermediate('sorted', ['q', 'g'], lambda s: SegmentSort(
+    s['q'], s['g']))
+RegisterIntermediate('median', ['sorted', 'offsets'], lambda s: SegmentMedian(
+    s['sorted'], s['offsets']))
+# number of days above the mean and above 3 times the median flow, the
+# latter found in the sorted segments the median comes from
+RegisterIntermediate('above mean', ['g', 'dev'], lambda s: np.bincount(
+    s['g'][s['dev'] > 0], minlength=s.nPeriods))
+RegisterIntermediate('above 3xMedian', ['sorted', 'offsets', 'median'],
+                     lambda s: s['offsets'][1:] - SegmentSearch(
+    s['sorted'], s['offsets'], 3*s['median'], side='right'))
+
+# the metrics of program_10
+RegisterMetric('Mean Flow', ['mean'], lambda s: s['mean'])
+RegisterMetric('Peak Flow', ['q', 'offsets'], lambda s: SegmentReduce(
+    np.maximum, s['q'], s['offsets']))
+RegisterMetric('Median Flow', ['median'], lambda s: s['median'])
+RegisterMetric('Coeff Var', ['m2Sum', 'n', 'mean'], lambda s: np.sqrt(
+    s['m2Sum']/(s['n'] - 1))/s['mean']*100)
+RegisterMetric('Skew', ['m2Sum', 'm3Sum', 'n', 'mean', 'nanCount'], CalcSkew)
+RegisterMetric('Tqmean', ['above mean', 'n'], lambda s: s['above mean']/s['n'])
+RegisterMetric('R-B index', ['path', 'total'], lambda s: s['path']/s['total'])
+RegisterMetric('7Q', [RegisterRollingMin(7)], lambda s: s['rolling min 7'])
+RegisterMetric('3xMedian', ['above 3xMedian'],
+               lambda s: s['above 3xMedian'].astype(float))
+
+# further metrics, asked for by name
+RegisterMetric('30Q', [RegisterRollingMin(30)], lambda s: s['rolling min 30'])
+# baseflow index: 7-day low flow over the mean flow of the period
+RegisterMetric('Baseflow Index', ['rolling min 7', 'mean'],
+               lambda s: s['rolling min 7']/s['mean'])
+for percent in (5, 10, 25, 50, 75, 90, 95):
+    RegisterFlowDuration(percent)
+
+
+def CalcSegmentMetrics(values, codes, nPeriods, metrics=METRICS):
+    """This function calculates the requested metrics for every period of a
+    discharge array.  values and codes are equal length arrays with codes
+    sorted in ascending order.  Only the intermediates the requested
+    metrics need are computed, each once, inside the 'metric:<name>' stage
+    of the first metric needing it.  NaN values are dropped the same
+    way the single-series functions in program_10 drop them, except for
+    Skew, which is NaN for any period holding a NoData value.  The routine
+    returns a dictionary of arrays of length nPeriods keyed by metric
+    name."""
+    unknown = [name for name in metrics if name not in METRIC_REGISTRY]
+    if unknown:
+        raise ValueError("unknown metrics {}, register them with "
+                         "RegisterMetric".format(', '.join(unknown)))
+    data = SegmentData(values, codes, nPeriods)
+    out = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name in metrics:
+            with Stage('metric:' + name) as stage:
+                for need in METRIC_REGISTRY[name][0]:
+                    data[need]
+                out[name] = METRIC_REGISTRY[name][1](data)
+                stage.rows = len(data.values)
+    return( out )
+
+
+def CalcColumnMetrics(discharge, site, codes, nPeriods, colname):
+    """This function calculates the metrics listed in colname from the
+    discharge and site number arrays of rows tagged with sorted period
+    codes.  A 'site_no' entry in colname is filled with the median site
+    number of each period, site may be None otherwise.  The routine returns
+    a dictionary of arrays of length nPeriods keyed by column name."""
+    metrics = [name for name in colname if name != 'site_no']
+    result = CalcSegmentMetrics(discharge, codes, nPeriods, metrics)
+    if 'site_no' in colname:
+        valid = ~np.isnan(site)
+        siteCodes = codes[valid]
+        result['site_no'] = SegmentMedian(
+            SegmentSort(site[valid], siteCodes),
+            GetSegmentOffsets(siteCodes, nPeriods))
+    return( result )
+
+
+def CalcPeriodMetrics(DataDF, period, colname):
+    """This function calculates the metrics listed in colname for every
+    water year ('WY') or month ('M') of a streamflow DataFrame indexed by
+    date.  A 'site_no' entry in colname is filled with the median site
+    number of each period.  The routine returns a DataFrame indexed by the
+    period start dates with the columns in colname order."""
+    dates = DataDF.index
+    order = None
+    if not dates.is_monotonic_increasing:
+        order = np.argsort(dates.values, kind='stable')
+        dates = dates[order]
+    codes, periodIndex = GetPeriodCodes(dates, period)
+
+    def column(name):
+        values = DataDF[name].to_numpy(dtype=np.float64, na_value=np.nan)
+        return( values if order is None else values[order] )
+
+    site = column('site_no') if 'site_no' in colname else None
+    result = CalcColumnMetrics(column('Discharge'), site, codes,
+                               len(periodIndex), colname)
+    return( pd.DataFrame(result, index=periodIndex, columns=colname) )
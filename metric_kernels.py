@@ -0,0 +1,145 @@
+#!/bin/env python
+"""
+Compiled segment kernels for the metric engine.
+
+The kernels walk each period segment of the valid discharge values with
+plain loops and write one value per period, without the deviation, diff or
+window-sum arrays of the NumPy intermediates.  One fused pass per segment
+gives the second and third moment sums, the R-B path length, the count of
+days above the mean and the 7-day low flow; other n-day low flows have a
+kernel of their own.  Moving averages keep a running window sum, so an
+n-day low flow costs about the same whatever n is.
+
+The kernels are compiled with Numba when it is installed and registered as
+the 'numba' backend of metric_engine (metric_engine.SetBackend('numba') or
+STREAMFLOW_BACKEND=numba).  Without Numba the NumPy intermediates are used.
+"""
+import numpy as np
+
+from metric_engine import RegisterBackend
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# window of the n-day low flow computed in the fused pass (7Q)
+FUSED_WINDOW = 7
+
+
+def FusedKernel(q, offsets, mean, window, m2Sum, m3Sum, path, above,
+                rollMin):
+    """This function fills, for every segment of q bounded by offsets, the
+    sums of the squared and cubed deviations from mean, the sum of the
+    absolute day-to-day changes, the number of values above mean and the
+    lowest window-length moving average (NaN for segments shorter than
+    window)."""
+    for p in range(len(offsets) - 1):
+        lo = offsets[p]
+        hi = offsets[p + 1]
+        m = mean[p]
+        s2 = 0.0
+        s3 = 0.0
+        length = 0.0
+        count = 0
+        best = np.inf
+        winSum = 0.0
+        fresh = window - 1
+        for i in range(lo, hi):
+            d = q[i] - m
+            s2 += d*d
+            s3 += d*d*d
+            if d > 0:
+                count += 1
+            if i > lo:
+                length += abs(q[i] - q[i - 1])
+            # running window sum: the entering value in, the leaving one
+            # out, summed afresh once per window so rounding cannot build up
+            if fresh == 0:
+                winSum = q[i - window + 1]
+                for k in range(i - window + 2, i + 1):
+                    winSum += q[k]
+                fresh = window
+            else:
+                winSum += q[i]
+                if i - lo >= window:
+                    winSum -= q[i - window]
+            fresh -= 1
+            if i - lo >= window - 1 and winSum/window < best:
+                best = winSum/window
+        m2Sum[p] = s2
+        m3Sum[p] = s3
+        path[p] = length
+        above[p] = count
+        rollMin[p] = best if hi - lo >= window else np.nan
+
+
+def RollingMinKernel(q, offsets, window, rollMin):
+    """This function fills the lowest window-length moving average of every
+    segment of q bounded by offsets, NaN for segments shorter than
+    window."""
+    for p in range(len(offsets) - 1):
+        lo = offsets[p]
+        hi = offsets[p + 1]
+        best = np.inf
+        winSum = 0.0
+        fresh = window - 1
+        for i in range(lo, hi):
+            # running sum as in FusedKernel, summed afresh once per window
+            if fresh == 0:
+                winSum = q[i - window + 1]
+                for k in range(i - window + 2, i + 1):
+                    winSum += q[k]
+                fresh = window
+            else:
+                winSum += q[i]
+                if i - lo >= window:
+                    winSum -= q[i - window]
+            fresh -= 1
+            if i - lo >= window - 1 and winSum/window < best:
+                best = winSum/window
+        rollMin[p] = best if hi - lo >= window else np.nan
+
+
+def MakeLookup(compile):
+    """This function compiles the kernels with compile (numba.njit, or an
+    identity function to run them as plain Python) and returns the backend
+    lookup that computes the intermediates of metric_engine with them."""
+    fused = compile(FusedKernel)
+    rollingMin = compile(RollingMinKernel)
+
+    def Fused(s):
+        nPeriods = s.nPeriods
+        out = {'m2Sum': np.empty(nPeriods), 'm3Sum': np.empty(nPeriods),
+               'path': np.empty(nPeriods),
+               'above mean': np.empty(nPeriods, dtype=np.int64),
+               'rolling min {}'.format(FUSED_WINDOW): np.empty(nPeriods)}
+        fused(s['q'], s['offsets'], s['mean'], FUSED_WINDOW, out['m2Sum'],
+              out['m3Sum'], out['path'], out['above mean'],
+              out['rolling min {}'.format(FUSED_WINDOW)])
+        return( out )
+
+    def RollingMin(window):
+        def Compute(s):
+            out = np.empty(s.nPeriods)
+            rollingMin(s['q'], s['offsets'], window, out)
+            return( out )
+        return( Compute )
+
+    fusedNames = ['m2Sum', 'm3Sum', 'path', 'above mean',
+                  'rolling min {}'.format(FUSED_WINDOW)]
+
+    def Lookup(name):
+        if name == 'fused':
+            return( ['q', 'offsets', 'mean'], Fused )
+        if name in fusedNames:
+            return( ['fused'], lambda s: s['fused'][name] )
+        if name.startswith('rolling min '):
+            return( ['q', 'offsets'], RollingMin(int(name.split()[-1])) )
+        return( None )
+
+    return( Lookup )
+
+
+if numba is not None:
+    RegisterBackend('numba', MakeLookup(numba.njit(cache=True, nogil=True)))
@@ -0,0 +1,208 @@
+#!/bin/env python
+"""
+Output of the combined metrics tables.
+
+Each table is written once, from the concatenated results of all sites, in
+a single buffered pass with one header.  Besides the CSV and TAB delimited
+text files of program_10, the tables can be written as Parquet or Feather
+(these need pyarrow) or as NumPy .npz archives, and text output can be
+compressed with gzip, bz2, xz or zstd (zstd needs the zstandard package).
+A TableStream writes the text tables one site at a time instead, for
+pipelines that stream their results out.
+"""
+import bz2
+import gzip
+import lzma
+import os
+
+import numpy as np
+import pandas as pd
+
+# base file name and text delimiter of each table
+TABLE_FILES = {'annual': ('Annual_Metrics', ',', '.csv'),
+               'monthly': ('Monthly_Metrics', ',', '.csv'),
+               'annual_avg': ('Averaged_Annual_Metrics', '\t', '.txt'),
+               'monthly_avg': ('Averaged_Monthly_Metrics', '\t', '.txt')}
+
+# file name suffix of the compressed text files
+COMPRESSION_SUFFIX = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz',
+                      'zstd': '.zst'}
+
+# compression settings of the npz archives
+NPZ_COMPRESSION = ['off', 'on']
+
+FORMATS = ['text', 'parquet', 'feather', 'npz']
+
+
+def CombineTables(frames, stations):
+    """This function concatenates the per-site tables of one kind into one
+    table, in the order given.  The per-period tables, indexed by date, get
+    a "Station" column.  The averages lead with a "Station" index instead:
+    a per-site Series (the annual averages) becomes one row indexed by
+    station, and a per-site table (the monthly averages) keeps its Month
+    index under the station, as (Station, Month)."""
+    if len(frames) == 0:
+        return( pd.DataFrame() )
+    if isinstance(frames[0], pd.Series):
+        return( pd.DataFrame(list(frames),
+                             index=pd.Index(list(stations), name='Station')) )
+    if not isinstance(frames[0].index, pd.DatetimeIndex):
+        return( pd.concat(list(frames), keys=list(stations),
+                          names=['Station']) )
+    return( pd.concat([frame.assign(Station=station)
+                       for frame, station in zip(frames, stations)]) )
+
+
+def RequirePyarrow(fmt):
+    """This function raises an ImportError naming the missing dependency
+    of the Parquet and Feather formats."""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("the {} output format needs pyarrow, install it "
+                          "or use the text or npz format".format(fmt))
+
+
+def RequireZstandard():
+    """This function raises an ImportError naming the missing dependency
+    of zstd compression."""
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression needs zstandard, install it "
+                          "or use gzip, bz2 or xz")
+
+
+def CheckOutput(fmt='text', compression=None):
+    """This function checks an output format and compression, and that
+    their optional dependencies are installed, before any work is done.
+    A ValueError or ImportError is raised otherwise."""
+    if fmt not in FORMATS:
+        raise ValueError("unknown output format {!r}, use one of {}".format(
+            fmt, ', '.join(FORMATS)))
+    if fmt in ('parquet', 'feather'):
+        RequirePyarrow(fmt)
+    if fmt == 'text' and compression is not None:
+        if compression not in COMPRESSION_SUFFIX:
+            raise ValueError("unknown compression {!r}, use one of {}".format(
+                compression, ', '.join(COMPRESSION_SUFFIX)))
+        if compression == 'zstd':
+            RequireZstandard()
+    if fmt == 'npz':
+        CheckNpzCompression(compression)
+
+
+def CheckNpzCompression(compression):
+    """This function raises a ValueError for a compression of the npz
+    archives other than None, 'off' or 'on'."""
+    if compression is not None and compression not in NPZ_COMPRESSION:
+        raise ValueError("npz compression must be {}, not {!r}".format(
+            ' or '.join(NPZ_COMPRESSION), compression))
+
+
+def WriteNpz(table, path, compression=None):
+    """This function writes a table to a .npz archive with one array per
+    column, the index under '__index__' and text columns as str arrays.
+    The archive is deflate compressed when compression is 'on'."""
+    arrays = {'__index__': table.index.values}
+    if arrays['__index__'].dtype == object:
+        arrays['__index__'] = arrays['__index__'].astype(str)
+    for name in table.columns:
+        values = table[name].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays[str(name)] = values
+    CheckNpzCompression(compression)
+    save = np.savez_compressed if compression == 'on' else np.savez
+    with open(path, 'wb') as f:
+        save(f, **arrays)
+
+
+def WriteTable(table, name, outputDir='.', fmt='text', compression=None):
+    """This function writes one of the tables in TABLE_FILES to outputDir
+    and returns the path written.  compression applies to the text and
+    npz formats (npz only knows on or off) and is passed as the codec name
+    to Parquet and Feather."""
+    base, sep, suffix = TABLE_FILES[name]
+    path = os.path.join(outputDir, base)
+    if fmt == 'text':
+        path += suffix + COMPRESSION_SUFFIX.get(compression, '')
+        table.to_csv(path, sep=sep, compression=compression)
+    elif fmt == 'parquet':
+        RequirePyarrow(fmt)
+        path += '.parquet'
+        table.to_parquet(path, compression=compression)
+    elif fmt == 'feather':
+        RequirePyarrow(fmt)
+        path += '.feather'
+        table.reset_index().to_feather(path, compression=compression)
+    elif fmt == 'npz':
+        path += '.npz'
+        WriteNpz(table, path, compression)
+    else:
+        raise ValueError("unknown output format {!r}, use one of {}".format(
+            fmt, ', '.join(FORMATS)))
+    return( path )
+
+
+def WriteTables(tables, outputDir='.', fmt='text', compression=None):
+    """This function writes a dictionary of tables keyed by the names in
+    TABLE_FILES and returns the list of paths written."""
+    return( [WriteTable(table, name, outputDir, fmt, compression)
+             for name, table in tables.items()] )
+
+
+def OpenText(path, compression=None):
+    """This function opens a text file for writing, through the given
+    compression."""
+    if compression is None:
+        return( open(path, 'w', newline='') )
+    if compression == 'gzip':
+        return( gzip.open(path, 'wt', newline='') )
+    if compression == 'bz2':
+        return( bz2.open(path, 'wt', newline='') )
+    if compression == 'xz':
+        return( lzma.open(path, 'wt', newline='') )
+    if compression == 'zstd':
+        RequireZstandard()
+        import zstandard
+        return( zstandard.open(path, 'wt', newline='') )
+    raise ValueError("unknown compression {!r}, use one of {}".format(
+        compression, ', '.join(COMPRESSION_SUFFIX)))
+
+
+class TableStream(object):
+    """Text files of the tables in TABLE_FILES written one part at a time,
+    with the header of each table written before its first part.  The
+    files hold the same text as WriteTables gives for the concatenated
+    parts."""
+
+    def __init__(self, outputDir='.', compression=None):
+        self.outputDir = outputDir
+        self.compression = compression
+        self.files = {}
+        self.paths = {}
+
+    def Write(self, name, table):
+        """This function appends a part of one of the tables."""
+        base, sep, suffix = TABLE_FILES[name]
+        header = name not in self.files
+        if header:
+            path = os.path.join(self.outputDir, base + suffix +
+                                COMPRESSION_SUFFIX.get(self.compression, ''))
+            self.files[name] = OpenText(path, self.compression)
+            self.paths[name] = path
+        table.to_csv(self.files[name], sep=sep, header=header)
+
+    def Close(self, names=TABLE_FILES):
+        """This function closes the files, writing an empty table for each
+        of names that got no part, and returns the list of paths."""
+        for name in names:
+            if name not in self.files:
+                self.paths[name] = WriteTable(pd.DataFrame(), name,
+                                              self.outputDir, 'text',
+                                              self.compression)
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        return( [self.paths[name] for name in names] )
@@ -14,11 +14,20 @@ This script is written for annual and monthly analysis of streamflow dataset
 Also, the data quality is checked and nan values are replaced
 """
 import pandas as pd
-import scipy.stats as stats
 import numpy as np
-from datetime import datetime, timedelta
+from metric_engine import CalcPeriodMetrics
+from usgs_rdb import ReadRDB, GetReaderKey
+from series_cache import SeriesCache
+from instrumentation import Stage
+from metric_output import CombineTables, WriteTables
 
-def ReadData( fileName ):
+# columns of the water year and monthly metrics tables
+ANNUAL_COLUMNS = ['site_no','Mean Flow','Peak Flow','Median Flow',
+                  'Coeff Var', 'Skew', 'Tqmean', 'R-B index','7Q',
+                  '3xMedian']
+MONTHLY_COLUMNS = ['site_no','Mean Flow','Coeff Var','Tqmean', 'R-B index']
+
+def ReadData( fileName, columns=None, cache=None ):
     """This function takes a filename as input, and returns a dataframe with
     raw data read from that file in a Pandas DataFrame.  The DataFrame index
     should be the year, month and day of the observation.  DataFrame headers
@@ -28,43 +37,82 @@ def ReadData( fileName ):
     help identifying other flags used by the USGS to indicate no data is 
     availabiel.  Function returns the completed DataFrame, and a dictionary 
     designed to contain all missing value counts that is initialized with
-    days missing between the first and last date of the file."""
-    
+    days missing between the first and last date of the file.  columns
+    optionally limits which of the other columns are loaded; "Discharge"
+    is always read.  When a SeriesCache is given as cache, the parsed file
+    is taken from (or stored in) the binary cache instead of re-parsing
+    the text; its columns then stay memory-mapped unless negative values
+    have to be dropped."""
+
     # define column names
-    colNames = ['agency_cd', 'site_no', 'Date', 'Discharge', 'Quality']
+    colNames = ['agency_cd', 'site_no', 'Discharge', 'Quality']
+    if columns is not None:
+        colNames = [name for name in colNames
+                    if name in columns or name == 'Discharge']
+
+    with Stage('ReadData') as stage:
+        # open and read the file with the dedicated RDB parser
+        if cache is None:
+            DataDF = ReadRDB(fileName, columns=colNames)
+        else:
+            # the cache holds every column of the file, select them on load
+            DataDF = cache.Get(fileName, ReadRDB, colNames, GetReaderKey())
+
+        # quantify the number of missing values
+        MissingValues = DataDF["Discharge"].isna().sum()
+        # drop negative discharge data as a gross error, copying the rows
+        # only when there are any
+        negative = DataDF["Discharge"] < 0
+        if negative.any():
+            DataDF = DataDF[~negative]
+        stage.rows = len(DataDF)
 
-    # open and read the file
-    DataDF = pd.read_csv(fileName, header=1, names=colNames,  
-                         delimiter=r"\s+",parse_dates=[2], comment='#',
-                         na_values=['Eqp'])
-    DataDF = DataDF.set_index('Date')
-    
-    # quantify the number of missing values
-    MissingValues = DataDF["Discharge"].isna().sum()
-    # find the index of negative discharge data
-    Negative_index= DataDF[DataDF["Discharge"]<0].index
-    # drop those data as a gross error
-    DataDF.drop(Negative_index, inplace=True)
-    
     return( DataDF, MissingValues )
 
 def ClipData( DataDF, startDate, endDate ):
     """This function clips the given time series dataframe to a given range 
-    of dates. Function returns the clipped dataframe and and the number of 
-    missing values."""
-    # transfer start date and end date into datetime format
-    D_start =datetime.strptime(startDate, '%Y-%m-%d')
-    D_end   =datetime.strptime(endDate,'%Y-%m-%d')
-    # find the index of negative discharge data
-    less_index  = DataDF[DataDF.index<D_start].index
-    larger_index= DataDF[DataDF.index>D_end].index
-    # drop the data points with date before startdate
-    DataDF.drop(less_index, inplace=True)
-    DataDF.drop(larger_index,inplace=True)
-    # report missing values
-    MissingValues = DataDF['Discharge'].isna().sum()
+    of dates. Function returns the clipped dataframe and and the number of
+    missing values.  The given dataframe is left untouched: on a sorted
+    date index the clipped dataframe is a slice of it, not a copy."""
+    with Stage('ClipData') as stage:
+        DataDF, MissingValues = ClipWindows( DataDF, [(startDate, endDate)] )[0]
+        stage.rows = len(DataDF)
     return( DataDF, MissingValues )
 
+def ClipWindows( DataDF, windows ):
+    """This function clips the given time series dataframe to each of a
+    list of (startDate, endDate) windows, both dates included.  The window
+    bounds are found by binary search on the sorted date index and every
+    clipped dataframe is a positional slice sharing the data of DataDF, so
+    many windows (e.g. sliding 30-year normals) cost no copies of the base
+    series.  Function returns a list of (clipped dataframe, number of
+    missing values) pairs in the order of windows."""
+    index = DataDF.index
+    if not index.is_monotonic_increasing:
+        # unsorted index, fall back to (copying) boolean masks
+        clips = [ DataDF[(index >= pd.Timestamp(start)) &
+                         (index <= pd.Timestamp(end))]
+                  for start, end in windows ]
+        return( [ (clip, clip['Discharge'].isna().sum()) for clip in clips ] )
+    # transfer start dates and end dates into datetime format
+    starts = pd.DatetimeIndex([pd.Timestamp(start) for start, end in windows])
+    ends   = pd.DatetimeIndex([pd.Timestamp(end) for start, end in windows])
+    # find the positions of the window bounds
+    first = index.searchsorted(starts, side='left')
+    last  = index.searchsorted(ends, side='right')
+    # running count of missing values gives the count of any window
+    nanCount = np.concatenate([[0], np.cumsum(DataDF['Discharge'].isna().values)])
+    return( [ (DataDF.iloc[i:j], nanCount[max(j, i)] - nanCount[i])
+              for i, j in zip(first, last) ] )
+
+def GetSlidingWindows( firstYear, lastYear, length=30, step=1 ):
+    """This function returns the (startDate, endDate) pairs of water year
+    windows of the given length (in years), moved by step years, that
+    start in water years firstYear to lastYear - length + 1.  Water year
+    1970 starts on 1969-10-01.  The pairs can be passed to ClipWindows."""
+    return( [ ('{}-10-01'.format(year - 1), '{}-09-30'.format(year + length - 1))
+              for year in range(firstYear, lastYear - length + 2, step) ] )
+
 def CalcTqmean(Qvalues):
     """This function computes the Tqmean of a series of data, typically
        a 1 year time series of streamflow, after filtering out NoData
@@ -121,61 +169,42 @@ def CalcExceed3TimesMedian(Qvalues):
     median3x = (Qvalues > (Qvalues.median())*3).sum()
     return ( median3x )
 
-def GetAnnualStatistics(DataDF):
+def GetAnnualStatistics(DataDF, resultCache=None, metrics=None):
     """This function calculates annual descriptive statistcs and metrics for 
     the given streamflow time series.  Values are retuned as a dataframe of
     annual values for each water year.  Water year, as defined by the USGS,
-    starts on October 1."""
-    # column_names:
-    colname = ['site_no','Mean Flow','Peak Flow','Median Flow',
-               'Coeff Var', 'Skew', 'Tqmean', 'R-B index','7Q',
-               '3xMedian']
-    # resample dataframe first with water year
-    DataDF_WY = DataDF.resample('AS-OCT')
-    WY_avg    = DataDF_WY.mean()
-    WYDataDF = pd.DataFrame(index=WY_avg.index,columns=colname)
-    # get site no
-    WYDataDF['site_no'] = DataDF_WY['site_no'].median()
-    # get annual mean
-    WYDataDF['Mean Flow'] = DataDF_WY['Discharge'].mean()
-    # get annual max
-    WYDataDF['Peak Flow']   = DataDF_WY['Discharge'].max()
-    # get annual median
-    WYDataDF['Median Flow'] =DataDF_WY['Discharge'].median()
-    # get Coeff Var
-    WYDataDF['Coeff Var']  = (DataDF_WY['Discharge'].std()/(DataDF_WY['Discharge'].mean()))*100
-    # get skewness
-    WYDataDF['Skew']   =DataDF_WY.apply({'Discharge': lambda x: stats.skew(x)})
-    # get T-Q mean
-    WYDataDF['Tqmean'] =DataDF_WY.apply({'Discharge': lambda x: CalcTqmean(x)})
-    # get RB index
-    WYDataDF['R-B index'] =DataDF_WY.apply({'Discharge': lambda x: CalcRBindex(x)})
-    # get 7-day low flow
-    WYDataDF['7Q'] =DataDF_WY.apply({'Discharge': lambda x: Calc7Q(x)})
-    # get 3xMedian
-    WYDataDF['3xMedian'] =DataDF_WY.apply({'Discharge': lambda x: CalcExceed3TimesMedian(x)})
+    starts on October 1.  With a ResultCache as resultCache, a table already
+    computed from the same data is returned from the cache.  metrics
+    optionally lists the metrics to compute, by name in the metric registry
+    of metric_engine, instead of the ANNUAL_COLUMNS."""
+    colname = ANNUAL_COLUMNS if metrics is None else ['site_no'] + list(metrics)
+    # compute the metrics for all water years in one vectorized pass
+    with Stage('GetAnnualStatistics') as stage:
+        compute = lambda df: CalcPeriodMetrics(df, 'WY', colname)
+        if resultCache is None:
+            WYDataDF = compute(DataDF)
+        else:
+            WYDataDF = resultCache.Get(DataDF, 'WY', colname, compute)
+        stage.rows = len(DataDF)
     
     return ( WYDataDF )
 
-def GetMonthlyStatistics(DataDF):
+def GetMonthlyStatistics(DataDF, resultCache=None, metrics=None):
     """This function calculates monthly descriptive statistics and metrics 
     for the given streamflow time series.  Values are returned as a dataframe
-    of monthly values for each year."""
-    colname = ['site_no','Mean Flow','Coeff Var','Tqmean', 'R-B index']
-    # resample dataframe first with water year
-    DataDF_M = DataDF.resample('MS')
-    M_avg    = DataDF_M.mean()
-    MoDataDF = pd.DataFrame(index=M_avg.index,columns=colname)
-    # get site no
-    MoDataDF['site_no'] = DataDF_M['site_no'].median()
-    # get annual mean
-    MoDataDF['Mean Flow'] = DataDF_M['Discharge'].mean()
-    # get Coeff Var
-    MoDataDF['Coeff Var']  = (DataDF_M['Discharge'].std()/(DataDF_M['Discharge'].mean()))*100
-    # get T-Q mean
-    MoDataDF['Tqmean'] =DataDF_M.apply({'Discharge': lambda x: CalcTqmean(x)})
-    # get RB index
-    MoDataDF['R-B index'] =DataDF_M.apply({'Discharge': lambda x: CalcRBindex(x)})    
+    of monthly values for each year.  With a ResultCache as resultCache, a
+    table already computed from the same data is returned from the cache.
+    metrics optionally lists the metrics to compute, by name in the metric
+    registry of metric_engine, instead of the MONTHLY_COLUMNS."""
+    colname = MONTHLY_COLUMNS if metrics is None else ['site_no'] + list(metrics)
+    # compute the metrics for all months in one vectorized pass
+    with Stage('GetMonthlyStatistics') as stage:
+        compute = lambda df: CalcPeriodMetrics(df, 'M', colname)
+        if resultCache is None:
+            MoDataDF = compute(DataDF)
+        else:
+            MoDataDF = resultCache.Get(DataDF, 'M', colname, compute)
+        stage.rows = len(DataDF)
 
     return ( MoDataDF )
 
@@ -183,18 +212,38 @@ def GetAnnualAverages(WYDataDF):
     """This function calculates annual average values for all statistics and
     metrics.  The routine returns an array of mean values for each metric
     in the original dataframe."""
-    AnnualAverages = WYDataDF.mean()
+    with Stage('GetAnnualAverages') as stage:
+        AnnualAverages = WYDataDF.mean()
+        stage.rows = len(WYDataDF)
     return( AnnualAverages )
 
 def GetMonthlyAverages(MoDataDF):
     """This function calculates annual average monthly values for all 
     statistics and metrics.  The routine returns an array of mean values 
-    for each metric in the original dataframe."""
-    Mon_avg = []
-    for i in range(12):
-        Mon_avg.append(MoDataDF.iloc[i:600:12].mean())
-    MonthlyAverages = pd.DataFrame(Mon_avg,index=[10,11,12,1,2,3,4,5,6,7,8,9])
-    MonthlyAverages = MonthlyAverages.sort_index()
+    for each metric in the original dataframe.  Rows are grouped on the
+    calendar month of the date index, so any record length and start month
+    work.  When the dataframe holds several sites, told apart by a "Station"
+    column or index level, the averages are computed for every station and
+    month in the same call and indexed by (Station, Month)."""
+    with Stage('GetMonthlyAverages') as stage:
+        index = MoDataDF.index
+        if isinstance(index, pd.MultiIndex):
+            index = index.get_level_values('Date')
+        month = pd.Index(pd.DatetimeIndex(index).month, name='Month')
+        if 'Station' in MoDataDF.columns:
+            keys = [MoDataDF['Station'].values, month]
+            values = MoDataDF.drop(columns='Station')
+        elif 'Station' in MoDataDF.index.names:
+            keys = [MoDataDF.index.get_level_values('Station'), month]
+            values = MoDataDF
+        else:
+            keys = [month]
+            values = MoDataDF
+        # one grouped mean over all stations and months
+        MonthlyAverages = values.groupby(keys).mean()
+        if len(keys) == 2:
+            MonthlyAverages.index.names = ['Station', 'Month']
+        stage.rows = len(MoDataDF)
     return( MonthlyAverages )
 
 # the following condition checks whether we are running as a script, in which 
@@ -217,17 +266,14 @@ if __name__ == '__main__':
     MoDataDF = {}
     AnnualAverages = {}
     MonthlyAverages = {}
-    # create output lists
-    AM_out = []
-    MM_out = []
-    AA_out = []
-    MA_out = []
+    # keep parsed input files in a binary cache between runs
+    cache = SeriesCache('.series_cache')
     # process input datasets
     for file in fileName.keys():
         
         print( "\n", "="*50, "\n  Working on {} \n".format(file), "="*50, "\n" )
         
-        DataDF[file], MissingValues[file] = ReadData(fileName[file])
+        DataDF[file], MissingValues[file] = ReadData(fileName[file], cache=cache)
         print( "-"*50, "\n\nRaw data for {}...\n\n".format(file), DataDF[file].describe(), "\n\nMissing values: {}\n\n".format(MissingValues[file]))
         
         # clip to consistent period
@@ -249,56 +295,10 @@ if __name__ == '__main__':
         MonthlyAverages[file] = GetMonthlyAverages(MoDataDF[file])
         
         print("-"*50, "\n\nSummary of monthly metrics...\n\n", MoDataDF[file].describe(), "\n\nAnnual Monthly Averages...\n\n", MonthlyAverages[file])
-        
-        # output annual and monthly metrics tables
-        # store annual metrics
-        WYDataDF[file]['Station']=file
-        AM_out.append(WYDataDF[file])
-        # store monthly metrics
-        MoDataDF[file]['Station']=file
-        MM_out.append(MoDataDF[file])
-        
-        # store annual average
-        AnnualAverages[file]['Station']=file
-        AA_out.append(AnnualAverages[file])
-        # store monthly average
-        MonthlyAverages[file]['Station']=file
-        MA_out.append(MonthlyAverages[file])
 
-    # output all the files
-    # output Annual Metrics
-    f_AM = open('Annual_Metrics.csv', 'w')
-    i = 0
-    for AM in AM_out:
-        if i >0:
-              f_AM = open('Annual_Metrics.csv', 'a')  
-        AM.to_csv(f_AM)
-        i+=1
-    f_AM.close()
-    # output Monthly Metrics
-    f_MM = open('Monthly_Metrics.csv', 'w')
-    i = 0
-    for MM in MM_out:
-        if i>0:
-            f_MM = open('Monthly_Metrics.csv', 'a')
-        MM.to_csv(f_MM)
-        i+=1
-    f_MM.close()    
-    # output Averaged Annual Metrics
-    f_AA = open('Averaged_Annual_Metrics.txt', 'w')
-    i=0
-    for AA in AA_out:
-        if i >0:
-            f_AA = open('Averaged_Annual_Metrics.txt', 'a')
-        AA.to_csv(f_AA,sep='\t')
-        i+=1
-    f_AA.close()  
-    # output Averaged Monthly Metrics
-    f_MA = open('Averaged_Monthly_Metrics.txt', 'w')
-    i = 0
-    for MA in MA_out:
-        if i>0:
-            f_MA = open('Averaged_Monthly_Metrics.txt', 'a')
-        MA.to_csv(f_MA,sep='\t')
-        i+=1
-    f_MA.close()
\ No newline at end of file
+    # output all the files, each table written once for all stations
+    stations = list(fileName.keys())
+    WriteTables({'annual': CombineTables([WYDataDF[s] for s in stations], stations),
+                 'monthly': CombineTables([MoDataDF[s] for s in stations], stations),
+                 'annual_avg': CombineTables([AnnualAverages[s] for s in stations], stations),
+                 'monthly_avg': CombineTables([MonthlyAverages[s] for s in stations], stations)})
@@ -0,0 +1,220 @@
+#!/bin/env python
+"""
+Command line entry point for the program_10 streamflow statistics.
+
+    program_10_cli.py FILE [FILE ...] [--period WY|M|both] [--format text]
+    program_10_cli.py --serve               # JSON jobs on stdin
+    program_10_cli.py --serve --socket PATH # JSON jobs on a Unix socket
+
+Only argparse and json are loaded at start up; pandas, NumPy and the
+metric modules are imported when the first job runs, so --help and
+argument errors return at once.  Skew is computed by the metric engine
+itself, scipy is never loaded.  In server mode the modules are imported
+once and a result cache is kept for the life of the process, so a
+scheduler sending many jobs pays the start up cost once.
+
+A job is a JSON object on one line with the keys of the command line
+options: {"files": ["Tippe=TippecanoeRiver_....txt"], "period": "WY",
+"start": "1969-10-01", "end": "2019-09-30", "metrics": null,
+"format": "text", "compression": null, "output_dir": "out"}.  Every job is
+answered by one JSON line: {"ok": true, "paths": [...], "missing": {...}}
+or {"ok": false, "error": "..."}.
+"""
+import argparse
+import json
+import os
+import stat
+import sys
+
+# default analysis period, same as program_10
+START_DATE = '1969-10-01'
+END_DATE = '2019-09-30'
+
+# tables written for each period choice
+PERIOD_TABLES = {'WY': ['annual', 'annual_avg'],
+                 'M': ['monthly', 'monthly_avg'],
+                 'both': ['annual', 'monthly', 'annual_avg', 'monthly_avg']}
+
+# output formats and compressions of metric_output, listed here so
+# the arguments are checked without importing it
+FORMATS = ['text', 'parquet', 'feather', 'npz']
+TEXT_COMPRESSIONS = ['gzip', 'bz2', 'xz', 'zstd']
+NPZ_COMPRESSIONS = ['off', 'on']
+
+# defaults of the job keys
+JOB_DEFAULTS = {'period': 'both', 'start': START_DATE, 'end': END_DATE,
+                'metrics': None, 'format': 'text', 'compression': None,
+                'output_dir': '.'}
+
+
+def ParseSite(arg):
+    """This function splits a "station=file" argument into its station and
+    file; a bare file is named after its file name up to the first '_'."""
+    if '=' in arg:
+        station, fileName = arg.split('=', 1)
+        return( station, fileName )
+    return( os.path.basename(arg).split('_')[0], arg )
+
+
+def RunJob(job, resultCache=None):
+    """This function runs one job, a dictionary with a 'files' list and
+    the optional keys of JOB_DEFAULTS, and returns the paths written and
+    the missing value counts of every station.  A job without files
+    raises a ValueError, so it never overwrites the tables of output_dir
+    with empty ones.  The heavy modules are imported on the first call."""
+    from program_10 import (ReadData, ClipData, GetAnnualStatistics,
+                            GetMonthlyStatistics, GetAnnualAverages,
+                            GetMonthlyAverages)
+    from metric_output import CheckOutput, CombineTables, WriteTables
+
+    unknown = set(job) - set(JOB_DEFAULTS) - {'files'}
+    if unknown:
+        raise ValueError("unknown job keys {}".format(
+            ', '.join(sorted(unknown))))
+    if not job.get('files'):
+        raise ValueError("the job lists no files")
+    options = dict(JOB_DEFAULTS, **job)
+    if options['period'] not in PERIOD_TABLES:
+        raise ValueError("period must be one of {}".format(
+            ', '.join(PERIOD_TABLES)))
+    CheckOutput(options['format'], options['compression'])
+    names = PERIOD_TABLES[options['period']]
+    tables = {name: [] for name in names}
+    stations = []
+    missing = {}
+    for station, fileName in [ParseSite(arg) for arg in job['files']]:
+        DataDF, MissingValues = ReadData(fileName)
+        DataDF, missing[station] = ClipData(DataDF, options['start'],
+                                            options['end'])
+        stations.append(station)
+        if 'annual' in names:
+            WYDataDF = GetAnnualStatistics(DataDF, resultCache,
+                                           options['metrics'])
+            tables['annual'].append(WYDataDF)
+            tables['annual_avg'].append(GetAnnualAverages(WYDataDF))
+        if 'monthly' in names:
+            MoDataDF = GetMonthlyStatistics(DataDF, resultCache,
+                                            options['metrics'])
+            tables['monthly'].append(MoDataDF)
+            tables['monthly_avg'].append(GetMonthlyAverages(MoDataDF))
+    os.makedirs(options['output_dir'], exist_ok=True)
+    paths = WriteTables({name: CombineTables(tables[name], stations)
+                         for name in names}, options['output_dir'],
+                        options['format'], options['compression'])
+    return( {'paths': paths,
+             'missing': {s: int(n) for s, n in missing.items()}} )
+
+
+def AnswerJob(line, resultCache):
+    """This function runs the JSON job on one line and returns the JSON
+    line answering it.  A failed job is answered with its error."""
+    try:
+        answer = dict(ok=True, **RunJob(json.loads(line), resultCache))
+    except Exception as error:
+        answer = {'ok': False,
+                  'error': '{}: {}'.format(type(error).__name__, error)}
+    return( json.dumps(answer) + '\n' )
+
+
+def ServeStream(lines, out, resultCache):
+    """This function answers the jobs of an iterable of lines on out,
+    skipping blank lines, until the lines run out."""
+    for line in lines:
+        if line.strip():
+            out.write(AnswerJob(line, resultCache))
+            out.flush()
+
+
+def ServeSocket(path, resultCache):
+    """This function answers jobs on a Unix domain socket at path, one
+    connection at a time, each sending any number of job lines, until the
+    process is interrupted.  A stale socket left at path is replaced; any
+    other file there raises a FileExistsError."""
+    import socketserver
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(AnswerJob(line.decode('utf-8'),
+                                               resultCache).encode('utf-8'))
+                    self.wfile.flush()
+
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError("{} exists and is not a socket".format(path))
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, JobHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def main(argv=None):
+    """Command line entry: run one job from the arguments, or serve jobs
+    on stdin or a Unix socket with --serve."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('files', nargs='*',
+                        help='RDB files, optionally as station=file')
+    parser.add_argument('--period', choices=sorted(PERIOD_TABLES),
+                        default='both',
+                        help='water year (WY) or monthly (M) metrics')
+    parser.add_argument('--start', default=START_DATE)
+    parser.add_argument('--end', default=END_DATE)
+    parser.add_argument('--metrics', nargs='+', default=None,
+                        help='metric names to compute instead of the '
+                             'program_10 ones')
+    parser.add_argument('--format', choices=FORMATS, default='text')
+    parser.add_argument('--compression', default=None,
+                        help='{} for text output, {} for npz, a codec name '
+                             'for parquet and feather'.format(
+                                 ', '.join(TEXT_COMPRESSIONS),
+                                 '/'.join(NPZ_COMPRESSIONS)))
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--serve', action='store_true',
+                        help='answer JSON jobs, one per line, on stdin')
+    parser.add_argument('--socket', default=None,
+                        help='with --serve, listen on this Unix socket')
+    parser.add_argument('--result-cache-dir', default=None,
+                        help='with --serve, keep metric tables on disk too')
+    args = parser.parse_args(argv)
+
+    if (args.format == 'text' and args.compression is not None
+            and args.compression not in TEXT_COMPRESSIONS):
+        parser.error('text output takes --compression {}'.format(
+            ', '.join(TEXT_COMPRESSIONS)))
+    if (args.format == 'npz' and args.compression is not None
+            and args.compression not in NPZ_COMPRESSIONS):
+        parser.error('npz output takes --compression {}'.format(
+            ' or '.join(NPZ_COMPRESSIONS)))
+
+    if not args.serve:
+        if not args.files:
+            parser.error('give the RDB files to process, or --serve')
+        answer = RunJob({'files': args.files, 'period': args.period,
+                         'start': args.start, 'end': args.end,
+                         'metrics': args.metrics, 'format': args.format,
+                         'compression': args.compression,
+                         'output_dir': args.output_dir})
+        print('\n'.join(answer['paths']))
+        return( 0 )
+
+    # one result cache for all the jobs of the server
+    from result_cache import ResultCache
+    resultCache = ResultCache(cacheDir=args.result_cache_dir)
+    if args.socket is None:
+        ServeStream(sys.stdin, sys.stdout, resultCache)
+    else:
+        try:
+            ServeSocket(args.socket, resultCache)
+        except FileExistsError as error:
+            parser.error(str(error))
+    return( 0 )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/bin/env python
+"""
+Content-addressed cache of metric tables.
+
+A metrics table is keyed on a hash of the discharge data it is computed
+from (dates, discharge and site numbers), the period and the list of
+metric columns, so the same site and period clipped again, in this run or
+a later one, gets its table back without recomputing it.  Tables are kept
+in an in-process LRU tier and, when a directory is given, in an on-disk
+tier of .npz files whose least recently used files are evicted once the
+tier grows past its size limit.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# bump when the metric definitions change, older results are then ignored
+RESULT_VERSION = 1
+
+
+def HashData(DataDF, period, colname):
+    """This function returns the hex key of the metrics table of DataDF
+    for a period and list of metric columns."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update('{}|{}|{}'.format(RESULT_VERSION, period,
+                                    '|'.join(colname)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(
+        DataDF.index.values.astype('datetime64[ns]')).view(np.uint8))
+    for name in ('Discharge', 'site_no'):
+        if name in DataDF and (name == 'Discharge' or name in colname):
+            digest.update(name.encode('utf-8'))
+            digest.update(np.ascontiguousarray(DataDF[name].to_numpy(
+                dtype=np.float64, na_value=np.nan)).view(np.uint8))
+    return( digest.hexdigest() )
+
+
+class ResultCache(object):
+    """Two-tier cache of metrics tables: up to maxItems tables in memory
+    and, when cacheDir is given, up to maxBytes of .npz files on disk."""
+
+    def __init__(self, maxItems=256, cacheDir=None, maxBytes=512*1024**2):
+        self.maxItems = maxItems
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    def Get(self, DataDF, period, colname, compute):
+        """This function returns the metrics table of DataDF, taken from
+        the cache or computed by compute(DataDF) and stored.  The table
+        returned is a copy the caller may change."""
+        key = HashData(DataDF, period, colname)
+        table = self.Lookup(key)
+        if table is None:
+            self.misses += 1
+            table = compute(DataDF)
+            self.Store(key, table)
+        else:
+            self.hits += 1
+        return( table.copy() )
+
+    def Lookup(self, key):
+        """This function returns the cached table of a key, or None.  A
+        disk file that cannot be read, such as one truncated by a crash, is
+        removed and counts as a miss."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return( self.memory[key] )
+        if self.cacheDir is None:
+            return( None )
+        path = os.path.join(self.cacheDir, key + '.npz')
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                table = pd.DataFrame(data['values'],
+                                     index=pd.DatetimeIndex(data['index'],
+                                                            name='Date'),
+                                     columns=list(data['columns']))
+        except FileNotFoundError:
+            return( None )
+        except Exception:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return( None )
+        # mark the file as recently used and promote it to memory
+        os.utime(path)
+        self.Remember(key, table)
+        return( table )
+
+    def Store(self, key, table):
+        """This function stores a table in both tiers.  The file is written
+        under a name of its own and then swapped in, so processes storing
+        the same key do not collide."""
+        self.Remember(key, table)
+        if self.cacheDir is None:
+            return
+        path = os.path.join(self.cacheDir, key + '.npz')
+        handle, tmpPath = tempfile.mkstemp(dir=self.cacheDir, prefix='.tmp',
+                                           suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, values=table.to_numpy(dtype=np.float64),
+                         index=table.index.values.astype('datetime64[ns]'),
+                         columns=np.array(table.columns, dtype=str))
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+        self.Evict()
+
+    def Remember(self, key, table):
+        """This function keeps a table in the in-process LRU tier."""
+        self.memory[key] = table
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxItems:
+            self.memory.popitem(last=False)
+
+    def Evict(self):
+        """This function removes the least recently used files until the
+        disk tier fits in maxBytes."""
+        if self.maxBytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.cacheDir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        total = sum(size for used, size, path in entries)
+        for used, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def Clear(self):
+        """This function empties both tiers."""
+        self.memory.clear()
+        if self.cacheDir is not None:
+            for name in os.listdir(self.cacheDir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cacheDir, name))
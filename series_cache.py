@@ -0,0 +1,223 @@
+#!/bin/env python
+"""
+Binary columnar cache of parsed discharge series.
+
+Every parsed source file is stored in its own directory of .npy files, one
+per column (categoricals as integer codes plus their categories), next to a
+small JSON record of the source path, size, modification time and content
+hash.  An entry is keyed on the source path and on a reader key naming the
+parser, its version and its options, so a changed reader parses the file
+again.  Later reads memory-map the arrays instead of parsing the text
+again: the DataFrame of a hit is built on copy-on-write mappings of the
+.npy files, so only the pages used are read and a change made to the
+frame never reaches the cache.  The cache is bounded in size: the least
+recently used entries are evicted once the total size grows past the
+limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# bump when the on-disk layout changes, older entries are then re-parsed
+CACHE_VERSION = 2
+
+
+def HashFile(fileName, blockSize=1 << 20):
+    """This function returns the hex digest of the content of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            digest.update(block)
+    return( digest.hexdigest() )
+
+
+class SeriesCache(object):
+    """Size-bounded cache of parsed series kept under cacheDir.  maxBytes is
+    the limit on the total size of the cached arrays, None for no limit."""
+
+    def __init__(self, cacheDir, maxBytes=2*1024**3):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def EntryDir(self, fileName, reader=''):
+        """This function returns the cache directory used for a source file
+        read by the reader named reader, keyed on its absolute path and the
+        reader."""
+        key = '{}\0{}'.format(os.path.abspath(fileName), reader)
+        key = hashlib.blake2b(key.encode('utf-8'), digest_size=10).hexdigest()
+        return( os.path.join(self.cacheDir, key) )
+
+    def Lookup(self, fileName, reader=''):
+        """This function returns the cache record of a source file when the
+        entry is still valid, and None otherwise.  The size and the
+        modification time are compared first; when only the modification
+        time differs the content hash decides, so a touched but unchanged
+        file is not parsed again."""
+        metaFile = os.path.join(self.EntryDir(fileName, reader), 'meta.json')
+        try:
+            with open(metaFile, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return( None )
+        info = os.stat(fileName)
+        if (meta.get('version') != CACHE_VERSION
+                or meta.get('reader') != reader
+                or meta['path'] != os.path.abspath(fileName)
+                or meta['size'] != info.st_size):
+            return( None )
+        if meta['mtime_ns'] != info.st_mtime_ns:
+            if meta['hash'] != HashFile(fileName):
+                return( None )
+            # same content, remember the new modification time
+            meta['mtime_ns'] = info.st_mtime_ns
+            self.WriteMeta(metaFile, meta)
+        # mark the entry as recently used for the eviction policy
+        os.utime(metaFile)
+        return( meta )
+
+    def Get(self, fileName, parser, columns=None, reader=''):
+        """This function returns the DataFrame of a source file, parsing it
+        with parser(fileName) and storing the result on a cache miss.
+        reader names the parser, its version and options (see EntryDir);
+        columns optionally selects the columns returned."""
+        meta = self.Lookup(fileName, reader)
+        if meta is None:
+            DataDF = parser(fileName)
+            self.Put(fileName, DataDF, reader)
+            return( DataDF if columns is None else DataDF[columns] )
+        return( self.Load(fileName, meta, columns, reader) )
+
+    def LoadArrays(self, fileName, meta=None, reader='', mmapMode='r'):
+        """This function returns the memory-mapped arrays of a cached source
+        file as a dictionary keyed by file name stem ('Date', column names
+        and their '.codes' / '.categories' parts), or None on a miss."""
+        if meta is None:
+            meta = self.Lookup(fileName, reader)
+            if meta is None:
+                return( None )
+        entryDir = self.EntryDir(fileName, reader)
+        arrays = {}
+        for stem in meta['arrays']:
+            arrays[stem] = np.load(os.path.join(entryDir, stem + '.npy'),
+                                   mmap_mode=mmapMode)
+        return( arrays )
+
+    def Load(self, fileName, meta=None, columns=None, reader=''):
+        """This function rebuilds the DataFrame of a cached source file, or
+        of the given columns of it, or returns None on a miss.  The index
+        and the columns are copy-on-write memory maps of the cache files,
+        not copies: pages are read as they are used, and writes to the
+        frame stay private to it."""
+        if meta is None:
+            meta = self.Lookup(fileName, reader)
+            if meta is None:
+                return( None )
+        arrays = self.LoadArrays(fileName, meta, reader, mmapMode='c')
+        kinds = dict(meta['columns'])
+        if columns is None:
+            columns = [name for name, kind in meta['columns']]
+        index = pd.DatetimeIndex(arrays['Date'], name='Date')
+        data = {}
+        for name in columns:
+            if kinds[name] == 'category':
+                data[name] = pd.Categorical.from_codes(
+                    arrays[name + '.codes'], arrays[name + '.categories'])
+            else:
+                data[name] = arrays[name]
+        return( pd.DataFrame(data, index=index, columns=columns, copy=False) )
+
+    def Put(self, fileName, DataDF, reader=''):
+        """This function stores the DataFrame parsed from a source file by
+        the reader named reader, replacing any older entry, and then
+        applies the size limit."""
+        info = os.stat(fileName)
+        entryDir = self.EntryDir(fileName, reader)
+        tmpDir = tempfile.mkdtemp(dir=self.cacheDir, prefix='.tmp')
+        arrays = {'Date': DataDF.index.values.astype('datetime64[ns]')}
+        columns = []
+        for name in DataDF.columns:
+            col = DataDF[name]
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                arrays[name + '.codes'] = col.cat.codes.values
+                arrays[name + '.categories'] = col.cat.categories.values.astype(
+                    np.int64 if col.cat.categories.is_integer() else str)
+                columns.append((name, 'category'))
+            else:
+                arrays[name] = col.to_numpy()
+                columns.append((name, 'array'))
+        nbytes = 0
+        for stem, values in arrays.items():
+            np.save(os.path.join(tmpDir, stem + '.npy'), values,
+                    allow_pickle=False)
+            nbytes += values.nbytes
+        meta = {'version': CACHE_VERSION, 'reader': reader,
+                'path': os.path.abspath(fileName),
+                'size': info.st_size, 'mtime_ns': info.st_mtime_ns,
+                'hash': HashFile(fileName), 'columns': columns,
+                'arrays': list(arrays), 'nbytes': nbytes}
+        self.WriteMeta(os.path.join(tmpDir, 'meta.json'), meta)
+        # swap the new entry in place of the old one
+        shutil.rmtree(entryDir, ignore_errors=True)
+        os.replace(tmpDir, entryDir)
+        self.Evict()
+
+    def WriteMeta(self, metaFile, meta):
+        """This function writes a cache record atomically."""
+        tmpFile = metaFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmpFile, metaFile)
+
+    def Invalidate(self, fileName):
+        """This function drops the cache entries of a source file, whatever
+        reader they were parsed with."""
+        path = os.path.abspath(fileName)
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            try:
+                with open(os.path.join(entryDir, 'meta.json'), 'r') as f:
+                    if json.load(f)['path'] != path:
+                        continue
+            except (OSError, ValueError, KeyError):
+                continue
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+    def Clear(self):
+        """This function drops every cache entry."""
+        for name in os.listdir(self.cacheDir):
+            shutil.rmtree(os.path.join(self.cacheDir, name),
+                          ignore_errors=True)
+
+    def Entries(self):
+        """This function returns (last use, size, directory) for every
+        cache entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            metaFile = os.path.join(self.cacheDir, name, 'meta.json')
+            try:
+                with open(metaFile, 'r') as f:
+                    nbytes = json.load(f)['nbytes']
+                used = os.stat(metaFile).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((used, nbytes, os.path.dirname(metaFile)))
+        return( sorted(entries) )
+
+    def Evict(self):
+        """This function removes the least recently used entries until the
+        cache fits in maxBytes."""
+        if self.maxBytes is None:
+            return
+        entries = self.Entries()
+        total = sum(nbytes for used, nbytes, entryDir in entries)
+        for used, nbytes, entryDir in entries:
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            total -= nbytes
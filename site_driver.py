@@ -0,0 +1,302 @@
+#!/bin/env python
+"""
+Multi-site driver for the program_10 streamflow statistics.
+
+The per-site pipeline (ReadData -> ClipData -> GetAnnualStatistics ->
+GetMonthlyStatistics -> averages) is spread over a process pool.  Small
+files are packed into chunks so that one task does enough work to pay for
+the trip to a worker, results are gathered back in manifest order, and a
+site that fails is reported instead of stopping the run.  With --pipelined
+the sites go through the reader, worker and writer threads of
+site_pipeline instead, which overlap file reads with the computation.
+"""
+import argparse
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from program_10 import (ReadData, ClipData, GetAnnualStatistics,
+                        GetMonthlyStatistics, GetAnnualAverages,
+                        GetMonthlyAverages)
+from series_cache import SeriesCache
+from result_cache import ResultCache
+from instrumentation import Instrument, Stage
+from metric_output import (CombineTables, WriteTables, CheckOutput, FORMATS,
+                           TABLE_FILES)
+from metric_engine import SetBackend
+
+# default analysis period, same as program_10
+START_DATE = '1969-10-01'
+END_DATE = '2019-09-30'
+
+
+def ReadManifest(path):
+    """This function returns the list of (station, file) pairs to process.
+    path is either a directory, whose *.txt RDB files are taken in sorted
+    order with the station named after the file name up to the first '_'
+    (the tables this driver writes are left out), or a manifest file with
+    one "station,file" or "station<TAB>file" pair per line.  Blank lines
+    and lines starting with '#' are skipped, and relative file names are
+    taken from the manifest directory.  A ValueError is raised when there
+    are no sites or two sites share a station name, since their rows could
+    not be told apart in the combined tables."""
+    sites = []
+    if os.path.isdir(path):
+        outputs = [base for base, sep, suffix in TABLE_FILES.values()]
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.txt') and name[:-4] not in outputs:
+                sites.append((name.split('_')[0], os.path.join(path, name)))
+        return( CheckSites(sites, path) )
+    baseDir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            station, fileName = [s.strip() for s in
+                                 line.replace('\t', ',').split(',', 1)]
+            sites.append((station, os.path.join(baseDir, fileName)))
+    return( CheckSites(sites, path) )
+
+
+def CheckSites(sites, path):
+    """This function returns the (station, file) pairs read from path, or
+    raises a ValueError when there are none or a station name repeats."""
+    if not sites:
+        raise ValueError("no sites found in {}".format(path))
+    files = {}
+    for station, fileName in sites:
+        files.setdefault(station, []).append(os.path.basename(fileName))
+    repeated = ['{} ({})'.format(station, ', '.join(names))
+                for station, names in files.items() if len(names) > 1]
+    if repeated:
+        raise ValueError("station names repeat in {}: {}; name the sites in "
+                         "a manifest".format(path, '; '.join(repeated)))
+    return( sites )
+
+
+def ReadSite(result, fileName, startDate, endDate, cacheDir):
+    """This function reads and clips the data of one site, storing the
+    missing value counts in result, and returns the clipped DataFrame."""
+    cache = None if cacheDir is None else SeriesCache(cacheDir)
+    DataDF, result['missing_raw'] = ReadData(fileName, cache=cache)
+    DataDF, result['missing'] = ClipData(DataDF, startDate, endDate)
+    return( DataDF )
+
+
+def ComputeSite(result, DataDF, resultCacheDir=None):
+    """This function computes the metric tables of one site and their
+    averages, storing them in result."""
+    resultCache = None
+    if resultCacheDir is not None:
+        resultCache = ResultCache(cacheDir=resultCacheDir)
+    result['annual'] = GetAnnualStatistics(DataDF, resultCache)
+    result['monthly'] = GetMonthlyStatistics(DataDF, resultCache)
+    result['annual_avg'] = GetAnnualAverages(result['annual'])
+    result['monthly_avg'] = GetMonthlyAverages(result['monthly'])
+
+
+def RunPipeline(result, fileName, startDate, endDate, cacheDir,
+                resultCacheDir=None):
+    """This function runs the pipeline stages for one site, storing the
+    tables and missing value counts in result."""
+    DataDF = ReadSite(result, fileName, startDate, endDate, cacheDir)
+    ComputeSite(result, DataDF, resultCacheDir)
+
+
+def ProcessSite(station, fileName, startDate=START_DATE, endDate=END_DATE,
+                cacheDir=None, instrument=None, resultCacheDir=None):
+    """This function runs the full pipeline for one site.  The routine
+    returns a dictionary with the station name, the annual and monthly
+    metric tables, their averages and the missing value counts, or with an
+    'error' entry holding the traceback when the site fails.  instrument
+    is None, or a dictionary of Instrument arguments (traceMemory,
+    profile) to record the stages of the site under 'report'.  When
+    resultCacheDir is given, metric tables already computed from the same
+    data are taken from the result cache in that directory."""
+    result = {'station': station, 'file': fileName}
+    try:
+        if instrument is None:
+            RunPipeline(result, fileName, startDate, endDate, cacheDir,
+                        resultCacheDir)
+        else:
+            with Instrument(site=station, **instrument) as recorder:
+                try:
+                    RunPipeline(result, fileName, startDate, endDate,
+                                cacheDir, resultCacheDir)
+                finally:
+                    result['report'] = recorder.Report()
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return( result )
+
+
+def ProcessChunk(chunk, startDate, endDate, cacheDir, instrument=None,
+                 resultCacheDir=None):
+    """This function runs ProcessSite over a chunk of (position, station,
+    file) entries and returns the (position, result) pairs."""
+    return( [(pos, ProcessSite(station, fileName, startDate, endDate,
+                               cacheDir, instrument, resultCacheDir))
+             for pos, station, fileName in chunk] )
+
+
+def ChunkSites(sites, chunkBytes):
+    """This function packs consecutive sites into chunks of about
+    chunkBytes of input each, so many small files share one task while a
+    large file gets a task of its own."""
+    chunks = []
+    current = []
+    size = 0
+    for pos, (station, fileName) in enumerate(sites):
+        try:
+            fileSize = os.path.getsize(fileName)
+        except OSError:
+            # let ProcessSite report the missing file
+            fileSize = 0
+        if current and size + fileSize > chunkBytes:
+            chunks.append(current)
+            current = []
+            size = 0
+        current.append((pos, station, fileName))
+        size += fileSize
+    if current:
+        chunks.append(current)
+    return( chunks )
+
+
+def RunSites(sites, startDate=START_DATE, endDate=END_DATE, workers=None,
+             chunkBytes=4*1024**2, cacheDir=None, instrument=None,
+             resultCacheDir=None):
+    """This function processes a list of (station, file) pairs over a pool
+    of workers processes (all CPUs when workers is None, in this process
+    when workers is 1).  The routine returns the per-site results in the
+    order of sites; failed sites carry an 'error' entry.  instrument and
+    resultCacheDir are passed on to ProcessSite."""
+    results = [None]*len(sites)
+    chunks = ChunkSites(sites, chunkBytes)
+    if workers == 1:
+        for chunk in chunks:
+            for pos, result in ProcessChunk(chunk, startDate, endDate,
+                                            cacheDir, instrument,
+                                            resultCacheDir):
+                results[pos] = result
+        return( results )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(ProcessChunk, chunk, startDate, endDate,
+                               cacheDir, instrument, resultCacheDir): chunk
+                   for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                for pos, result in future.result():
+                    results[pos] = result
+            except Exception:
+                # the worker itself died, fail every site of the chunk
+                error = traceback.format_exc()
+                for pos, station, fileName in futures[future]:
+                    results[pos] = {'station': station, 'file': fileName,
+                                    'error': error}
+    return( results )
+
+
+def CombineResults(results):
+    """This function gathers the per-site results into the four output
+    tables, each carrying a "Station" column, in the order of results.
+    Failed sites are skipped.  The routine returns the annual metrics,
+    monthly metrics, annual averages (one row per station) and monthly
+    averages tables."""
+    done = [r for r in results if 'error' not in r]
+    stations = [r['station'] for r in done]
+    return( tuple(CombineTables([r[name] for r in done], stations)
+                  for name in ('annual', 'monthly', 'annual_avg',
+                               'monthly_avg')) )
+
+
+def main(argv=None):
+    """Command line entry: process every site of a manifest or directory
+    and write the four tables to the output directory."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('sites', help='manifest file or directory of RDB files')
+    parser.add_argument('--start', default=START_DATE)
+    parser.add_argument('--end', default=END_DATE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-bytes', type=int, default=4*1024**2)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--result-cache-dir', default=None,
+                        help='reuse metric tables computed in earlier runs')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--format', choices=FORMATS, default='text')
+    parser.add_argument('--compression', default=None,
+                        help='gzip, bz2, xz or zstd (text), on/off (npz), '
+                             'codec name (parquet, feather)')
+    parser.add_argument('--report', default=None,
+                        help='write per-site stage timings to this JSON file')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='add tracemalloc memory deltas to the report')
+    parser.add_argument('--profile', action='store_true',
+                        help='add a cProfile summary per site to the report')
+    parser.add_argument('--backend', choices=['numpy', 'numba'], default=None,
+                        help='segment kernels of the metric engine')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='overlap reading, computing and writing with '
+                             'reader, worker (--workers) and writer threads')
+    parser.add_argument('--readers', type=int, default=2,
+                        help='reader threads of --pipelined')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='sites held between the --pipelined stages')
+    args = parser.parse_args(argv)
+    if args.pipelined and args.report is not None:
+        parser.error('--report is not available with --pipelined')
+    # fail on the sites and output settings now rather than after every
+    # site is done
+    try:
+        sites = ReadManifest(args.sites)
+        CheckOutput(args.format, args.compression)
+        os.makedirs(args.output_dir, exist_ok=True)
+    except (ValueError, ImportError, OSError) as error:
+        parser.error(str(error))
+
+    if args.backend is not None:
+        # workers read the backend from the environment at start up
+        os.environ['STREAMFLOW_BACKEND'] = args.backend
+        SetBackend(args.backend)
+
+    instrument = None
+    if args.report is not None:
+        instrument = {'traceMemory': args.trace_memory,
+                      'profile': args.profile}
+    if args.pipelined:
+        # the pipeline streams the tables out itself
+        from site_pipeline import RunPipelined
+        results = RunPipelined(sites, args.start, args.end,
+                               args.readers, args.workers or 2,
+                               args.queue_size, None, args.output_dir,
+                               args.format, args.compression, args.cache_dir,
+                               args.result_cache_dir)
+    else:
+        results = RunSites(sites, args.start, args.end,
+                           args.workers, args.chunk_bytes, args.cache_dir,
+                           instrument, args.result_cache_dir)
+        with Instrument(site='output') as recorder:
+            with Stage('output'):
+                tables = dict(zip(('annual', 'monthly', 'annual_avg',
+                                   'monthly_avg'), CombineResults(results)))
+                WriteTables(tables, args.output_dir, args.format,
+                            args.compression)
+    if args.report is not None:
+        report = {'sites': [r.get('report', {'station': r['station']})
+                            for r in results],
+                  'output': recorder.Report()}
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    # report the failed sites, and fail the run only when nothing worked
+    failed = [r for r in results if 'error' in r]
+    for r in failed:
+        print("Site {} ({}) failed:\n{}".format(r['station'], r['file'],
+                                                r['error']), file=sys.stderr)
+    return( 1 if failed and len(failed) == len(results) else 0 )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/bin/env python
+"""
+Multi-site panel of daily discharge for cross-site analytics.
+
+All sites share one daily date axis.  The discharge of every site is a row
+of a 2-D site x day float32/float64 matrix, next to a boolean matrix that
+marks the days on which the site has a row (a present day may still hold
+a NaN discharge, as with 'Eqp' days).  The site number is stored once per
+site instead of once per row.  The matrices can live in ordinary memory, in
+memory-mapped files or in shared memory, so worker processes can attach to
+one copy of the panel.  The annual and monthly metrics of every site are
+computed in vectorized passes over blocks of whole sites, each block
+holding at most BLOCK_CELLS site days, so the working arrays of a pass
+stay a fixed size however many sites the panel holds.
+"""
+import json
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from metric_engine import GetPeriodCodes, CalcColumnMetrics, SegmentData
+from flow_duration import FlowDuration
+from program_10 import ReadData, ClipData, ANNUAL_COLUMNS, MONTHLY_COLUMNS
+
+STORAGES = [None, 'memmap', 'shared']
+
+# site days handled per pass over the panel, about 14 sites of 50 years
+# and some 25 MiB of working arrays; a block always holds at least one
+# whole site
+BLOCK_CELLS = 1 << 18
+
+
+def AllocateArray(shape, dtype, storage=None, location=None):
+    """This function allocates a zeroed array in ordinary memory (storage
+    None), in a memory-mapped file at location ('memmap') or in a new
+    shared memory block ('shared').  The routine returns the array, the
+    shared memory handle (or None) and the location to attach to it."""
+    dtype = np.dtype(dtype)
+    if storage is None:
+        return( np.zeros(shape, dtype=dtype), None, None )
+    if storage == 'memmap':
+        array = np.lib.format.open_memmap(location, mode='w+', dtype=dtype,
+                                          shape=shape)
+        return( array, None, location )
+    if storage == 'shared':
+        nbytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+        handle = shared_memory.SharedMemory(create=True, size=nbytes)
+        array = np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+        array[...] = 0
+        return( array, handle, handle.name )
+    raise ValueError("storage must be one of {}".format(STORAGES))
+
+
+def AttachArray(shape, dtype, storage, location):
+    """This function opens an array allocated by AllocateArray in another
+    process.  The routine returns the array and the shared memory handle
+    (or None)."""
+    if storage == 'memmap':
+        return( np.load(location, mmap_mode='r+'), None )
+    handle = shared_memory.SharedMemory(name=location)
+    return( np.ndarray(shape, dtype=np.dtype(dtype), buffer=handle.buf),
+            handle )
+
+
+class SitePanel(object):
+    """Site x day discharge matrix of several sites on one daily axis."""
+
+    def __init__(self, stations, siteNumbers, startDate, values, present,
+                 storage=None, locations=(None, None), handles=()):
+        self.stations = list(stations)
+        self.siteNumbers = np.asarray(siteNumbers, dtype=np.float64)
+        self.startDate = pd.Timestamp(startDate)
+        self.values = values
+        self.present = present
+        self.storage = storage
+        self.locations = locations
+        self.handles = list(handles)
+
+    @property
+    def dates(self):
+        """Daily date axis of the panel."""
+        return( pd.date_range(self.startDate, periods=self.values.shape[1],
+                              freq='D', name='Date') )
+
+    @classmethod
+    def Create(cls, stations, siteNumbers, startDate, nDays,
+               dtype=np.float64, storage=None, path=None):
+        """This function allocates an empty panel: every value NaN and no
+        day present.  With storage 'memmap', path is the base name of the
+        .values.npy, .present.npy and .json files."""
+        shape = (len(stations), int(nDays))
+        locations = [None, None]
+        if storage == 'memmap':
+            locations = [path + '.values.npy', path + '.present.npy']
+        values, valuesHandle, locations[0] = AllocateArray(
+            shape, dtype, storage, locations[0])
+        present, presentHandle, locations[1] = AllocateArray(
+            shape, bool, storage, locations[1])
+        values[...] = np.nan
+        panel = cls(stations, siteNumbers, startDate, values, present,
+                    storage, tuple(locations),
+                    [h for h in (valuesHandle, presentHandle) if h])
+        if storage == 'memmap':
+            with open(path + '.json', 'w') as f:
+                json.dump(panel.Describe(), f)
+        return( panel )
+
+    @classmethod
+    def FromFrames(cls, frames, dtype=np.float64, storage=None, path=None):
+        """This function builds a panel from a dictionary of daily
+        DataFrames (as returned by ReadData) keyed by station name."""
+        stations = list(frames)
+        starts = [frames[s].index.min() for s in stations if len(frames[s])]
+        ends = [frames[s].index.max() for s in stations if len(frames[s])]
+        startDate = min(starts).normalize() if starts else pd.Timestamp(0)
+        nDays = (max(ends).normalize() - startDate).days + 1 if ends else 0
+        siteNumbers = []
+        for station in stations:
+            DataDF = frames[station]
+            if 'site_no' in DataDF and len(DataDF):
+                siteNumbers.append(np.nanmedian(DataDF['site_no'].to_numpy(
+                    dtype=np.float64, na_value=np.nan)))
+            else:
+                siteNumbers.append(np.nan)
+        panel = cls.Create(stations, siteNumbers, startDate, nDays, dtype,
+                           storage, path)
+        for i, station in enumerate(stations):
+            DataDF = frames[station]
+            days = (DataDF.index.normalize() - startDate).days.values
+            panel.values[i, days] = DataDF['Discharge'].to_numpy(
+                dtype=np.float64, na_value=np.nan)
+            panel.present[i, days] = True
+        return( panel )
+
+    @classmethod
+    def FromFiles(cls, sites, startDate=None, endDate=None,
+                  dtype=np.float64, storage=None, path=None, cache=None):
+        """This function reads a list of (station, file) pairs with
+        ReadData, clips them to startDate..endDate when given, and builds
+        a panel of them."""
+        frames = {}
+        for station, fileName in sites:
+            DataDF, MissingValues = ReadData(fileName,
+                                             columns=['site_no', 'Discharge'],
+                                             cache=cache)
+            if startDate is not None or endDate is not None:
+                DataDF, MissingValues = ClipData(
+                    DataDF, startDate or DataDF.index.min(),
+                    endDate or DataDF.index.max())
+            frames[station] = DataDF
+        return( cls.FromFrames(frames, dtype, storage, path) )
+
+    def Describe(self):
+        """This function returns the small dictionary another process
+        needs to attach to a memmap or shared panel."""
+        return( {'stations': self.stations,
+                 'siteNumbers': [None if np.isnan(n) else float(n)
+                                 for n in self.siteNumbers],
+                 'startDate': str(self.startDate.date()),
+                 'shape': list(self.values.shape),
+                 'dtype': self.values.dtype.str,
+                 'storage': self.storage,
+                 'locations': list(self.locations)} )
+
+    @classmethod
+    def Attach(cls, description):
+        """This function attaches to the panel described by Describe()."""
+        if isinstance(description, str):
+            # base path of a memmap panel
+            with open(description + '.json', 'r') as f:
+                description = json.load(f)
+        shape = tuple(description['shape'])
+        storage = description['storage']
+        values, valuesHandle = AttachArray(shape, description['dtype'],
+                                           storage,
+                                           description['locations'][0])
+        present, presentHandle = AttachArray(shape, bool, storage,
+                                             description['locations'][1])
+        siteNumbers = [np.nan if n is None else n
+                       for n in description['siteNumbers']]
+        return( cls(description['stations'], siteNumbers,
+                    description['startDate'], values, present, storage,
+                    tuple(description['locations']),
+                    [h for h in (valuesHandle, presentHandle) if h]) )
+
+    def Close(self):
+        """This function releases the shared memory mappings of this
+        process."""
+        self.values = None
+        self.present = None
+        for handle in self.handles:
+            handle.close()
+
+    def Unlink(self):
+        """This function frees the shared memory blocks, once every process
+        has closed them."""
+        for handle in self.handles:
+            handle.unlink()
+
+    def GetBlocks(self, blockCells=BLOCK_CELLS):
+        """This function returns the (start, stop) site ranges of the
+        blocks of whole sites holding at most blockCells site days each."""
+        nSites, nDays = self.values.shape
+        step = max(1, blockCells//max(nDays, 1))
+        return( [(start, min(start + step, nSites))
+                 for start in range(0, max(nSites, 1), step)] )
+
+    def GetSegments(self, period, start=0, stop=None):
+        """This function tags the present cells of the sites start to stop
+        (by default all) with a code per site and water year ('WY') or
+        month ('M').  Each site keeps the periods between its first and
+        last present day, as GetAnnualStatistics/GetMonthlyStatistics would
+        give.  The routine returns the rows (counted from start) and days
+        of the present cells, their codes, the number of codes, the codes
+        kept and their (Station, Date) index."""
+        present = self.present[start:stop]
+        nSites = present.shape[0]
+        axisCodes, periodIndex = GetPeriodCodes(self.dates, period)
+        nPeriods = len(periodIndex)
+        # present cells in site-major order, so codes come out sorted
+        rows, days = np.nonzero(present)
+        codes = rows*nPeriods + axisCodes[days]
+        # periods from the first to the last present day of each site
+        counts = np.bincount(codes, minlength=nSites*nPeriods).reshape(
+            nSites, nPeriods)
+        seen = np.cumsum(counts, axis=1)
+        inRange = (seen > 0) & (seen - counts < seen[:, -1:])
+        siteIdx, periodIdx = np.nonzero(inRange)
+        keep = siteIdx*nPeriods + periodIdx
+        index = pd.MultiIndex.from_arrays(
+            [np.asarray(self.stations, dtype=object)[start + siteIdx],
+             periodIndex[periodIdx]], names=['Station', 'Date'])
+        return( rows, days, codes, nSites*nPeriods, keep, index )
+
+    def GetStatistics(self, period, colname, blockCells=BLOCK_CELLS):
+        """This function calculates the colname metrics of every site for
+        every water year ('WY') or month ('M'), one pass per block of at
+        most blockCells site days.  The routine returns a DataFrame indexed
+        by (Station, Date)."""
+        tables = []
+        for start, stop in self.GetBlocks(blockCells):
+            rows, days, codes, nCodes, keep, index = self.GetSegments(
+                period, start, stop)
+            result = CalcColumnMetrics(
+                self.values[start + rows, days].astype(np.float64),
+                self.siteNumbers[start + rows], codes, nCodes, colname)
+            tables.append(pd.DataFrame({name: result[name][keep]
+                                        for name in colname},
+                                       index=index, columns=colname))
+        return( pd.concat(tables) )
+
+    def GetFlowDuration(self, period, blockCells=BLOCK_CELLS):
+        """This function sorts the discharge of every site and water year
+        ('WY') or month ('M'), one pass per block of at most blockCells
+        site days.  The routine returns a FlowDuration indexed by
+        (Station, Date)."""
+        sortedValues = []
+        offsets = []
+        indexes = []
+        total = 0
+        for start, stop in self.GetBlocks(blockCells):
+            rows, days, codes, nCodes, keep, index = self.GetSegments(
+                period, start, stop)
+            data = SegmentData(self.values[start + rows, days], codes, nCodes)
+            # the periods left out hold no present day, so their segments
+            # are empty and the offsets of the periods kept stay contiguous
+            sortedValues.append(data['sorted'])
+            offsets.append(data['offsets'][keep] + total)
+            indexes.append(index)
+            total += len(data['sorted'])
+        return( FlowDuration(np.concatenate(sortedValues),
+                             np.append(np.concatenate(offsets), total),
+                             indexes[0].append(indexes[1:])) )
+
+    def GetAnnualStatistics(self):
+        """This function returns the water year metrics of every site."""
+        return( self.GetStatistics('WY', ANNUAL_COLUMNS) )
+
+    def GetMonthlyStatistics(self):
+        """This function returns the monthly metrics of every site."""
+        return( self.GetStatistics('M', MONTHLY_COLUMNS) )
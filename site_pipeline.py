@@ -0,0 +1,171 @@
+#!/bin/env python
+"""
+Pipelined multi-site ingestion for the program_10 streamflow statistics.
+
+The sites flow through three stages joined by bounded queues:
+
+    reader threads  -> ReadData + ClipData of the next RDB files
+    worker threads  -> annual/monthly metrics and their averages
+    writer thread   -> results streamed to the output tables in site order
+
+so the next files are read and parsed while earlier sites are computed and
+written, which hides the read latency of network filesystems and object
+store mounts.  A full queue blocks the stage feeding it, and at most
+`window` sites are between being read and written, so a slow stage holds
+back the others instead of piling up parsed data in memory.  A site that
+fails is reported and skipped, as in site_driver.
+"""
+import queue
+import threading
+import traceback
+
+from site_driver import ReadSite, ComputeSite, START_DATE, END_DATE
+from metric_output import CombineTables, TableStream, WriteTables
+
+# tables streamed for every site, in output order
+TABLES = ['annual', 'monthly', 'annual_avg', 'monthly_avg']
+
+# marks the end of the items of a queue
+_DONE = object()
+
+
+def ReaderStage(sites, window, parsed, startDate, endDate, cacheDir):
+    """This function reads sites from the sites queue, one window slot per
+    site, and puts (position, result, DataDF) items in the parsed queue
+    until the sites run out."""
+    while True:
+        # take the slot first, so the sites in flight are always the
+        # earliest ones and the writer never waits on a site not yet read
+        window.acquire()
+        try:
+            pos, station, fileName = sites.get_nowait()
+        except queue.Empty:
+            window.release()
+            return
+        result = {'station': station, 'file': fileName}
+        DataDF = None
+        try:
+            DataDF = ReadSite(result, fileName, startDate, endDate, cacheDir)
+        except Exception:
+            result['error'] = traceback.format_exc()
+        parsed.put((pos, result, DataDF))
+
+
+def WorkerStage(parsed, computed, resultCacheDir):
+    """This function computes the metrics of the items of the parsed queue
+    and puts the (position, result) pairs in the computed queue."""
+    while True:
+        item = parsed.get()
+        if item is _DONE:
+            return
+        pos, result, DataDF = item
+        if 'error' not in result:
+            try:
+                ComputeSite(result, DataDF, resultCacheDir)
+            except Exception:
+                result['error'] = traceback.format_exc()
+        computed.put((pos, result))
+
+
+def WriterStage(computed, window, results, outputDir, fmt, compression,
+                failure):
+    """This function writes the results of the computed queue in site
+    order, freeing a window slot per site written.  Text tables are
+    streamed site by site; the other formats are written once all sites
+    are in.  The results list gets the per-site results without their
+    streamed tables.  When the output fails, the traceback is appended to
+    failure and the remaining results are drained unwritten, so the other
+    stages still finish."""
+    try:
+        WriteResults(computed, window, results, outputDir, fmt, compression)
+    except Exception:
+        failure.append(traceback.format_exc())
+        while computed.get() is not _DONE:
+            window.release()
+
+
+def WriteResults(computed, window, results, outputDir, fmt, compression):
+    """This function does the work of WriterStage."""
+    stream = TableStream(outputDir, compression) if fmt == 'text' else None
+    kept = {name: [] for name in TABLES}
+    stations = []
+    pending = {}
+    nextPos = 0
+    while True:
+        item = computed.get()
+        if item is _DONE:
+            break
+        pending[item[0]] = item[1]
+        # write every result that is next in site order
+        while nextPos in pending:
+            result = pending.pop(nextPos)
+            if 'error' not in result:
+                if stream is None:
+                    stations.append(result['station'])
+                    for name in TABLES:
+                        kept[name].append(result[name])
+                else:
+                    for name in TABLES:
+                        stream.Write(name, CombineTables([result[name]],
+                                                         [result['station']]))
+                        del result[name]
+            results[nextPos] = result
+            nextPos += 1
+            window.release()
+    if stream is None:
+        WriteTables({name: CombineTables(kept[name], stations)
+                     for name in TABLES}, outputDir, fmt, compression)
+    else:
+        stream.Close(TABLES)
+
+
+def RunPipelined(sites, startDate=START_DATE, endDate=END_DATE, readers=2,
+                 workers=2, queueSize=4, window=None, outputDir='.',
+                 fmt='text', compression=None, cacheDir=None,
+                 resultCacheDir=None):
+    """This function processes a list of (station, file) pairs with readers
+    reader threads, workers compute threads and one writer thread, joined
+    by queues of queueSize items, with at most window sites in flight (by
+    default enough to keep every stage busy).  The four tables are written
+    to outputDir as WriteTables would write them.  The routine returns the
+    per-site results in the order of sites, holding the station, file and
+    missing value counts, or an 'error' entry for failed sites.  A
+    RuntimeError is raised when the output cannot be written."""
+    if window is None:
+        window = readers + workers + 2*queueSize + 1
+    siteQueue = queue.Queue()
+    for pos, (station, fileName) in enumerate(sites):
+        siteQueue.put((pos, station, fileName))
+    slots = threading.Semaphore(window)
+    parsed = queue.Queue(maxsize=queueSize)
+    computed = queue.Queue(maxsize=queueSize)
+    results = [None]*len(sites)
+    failure = []
+
+    readerThreads = [threading.Thread(target=ReaderStage,
+                                      args=(siteQueue, slots, parsed,
+                                            startDate, endDate, cacheDir),
+                                      name='reader-{}'.format(i))
+                     for i in range(readers)]
+    workerThreads = [threading.Thread(target=WorkerStage,
+                                      args=(parsed, computed, resultCacheDir),
+                                      name='worker-{}'.format(i))
+                     for i in range(workers)]
+    writerThread = threading.Thread(target=WriterStage,
+                                    args=(computed, slots, results, outputDir,
+                                          fmt, compression, failure),
+                                    name='writer')
+    for thread in readerThreads + workerThreads + [writerThread]:
+        thread.start()
+    # shut the stages down in order once the one before has finished
+    for thread in readerThreads:
+        thread.join()
+    for thread in workerThreads:
+        parsed.put(_DONE)
+    for thread in workerThreads:
+        thread.join()
+    computed.put(_DONE)
+    writerThread.join()
+    if failure:
+        raise RuntimeError("writing the output failed:\n" + failure[0])
+    return( results )
@@ -0,0 +1,147 @@
+#!/bin/env python
+"""
+Streaming computation of the water year and monthly metrics.
+
+The RDB file is read in chunks and every water year or month is reported as
+soon as a later date shows that it has closed.  The rows of the period that
+is still open are the only data carried from one chunk to the next: the
+median, Tqmean and 3xMedian need every value of their period, and the
+7-day windows and day-to-day changes of R-B index never cross a period
+boundary, so nothing older than the open period is ever kept.  Peak memory
+is bounded by one chunk plus one period instead of the record length.
+"""
+import numpy as np
+import pandas as pd
+
+from metric_engine import GetPeriodKeys, GetPeriodStarts, CalcColumnMetrics
+from program_10 import ANNUAL_COLUMNS, MONTHLY_COLUMNS
+from usgs_rdb import ReadRDBChunks
+
+
+class PeriodStream(object):
+    """Accumulates ascending chunks of a discharge series and computes the
+    colname metrics of every water year ('WY') or month ('M') once it has
+    closed.  Rows outside startDate..endDate are skipped and negative
+    discharges are dropped, as ReadData and ClipData do."""
+
+    def __init__(self, period, colname, startDate=None, endDate=None):
+        self.period = period
+        self.colname = colname
+        self.startDate = None if startDate is None else pd.Timestamp(startDate)
+        self.endDate = None if endDate is None else pd.Timestamp(endDate)
+        # rows of the open period
+        self.keys = np.empty(0, dtype=np.int64)
+        self.discharge = np.empty(0)
+        self.site = np.empty(0)
+        # key of the first period not reported yet
+        self.nextKey = None
+        self.missingValues = 0
+
+    def Push(self, DataDF):
+        """This function adds a chunk of rows, in date order, and returns a
+        DataFrame of the metrics of the periods it closed (possibly
+        empty)."""
+        dates = DataDF.index
+        keep = np.ones(len(DataDF), dtype=bool)
+        if self.startDate is not None:
+            keep &= dates >= self.startDate
+        if self.endDate is not None:
+            keep &= dates <= self.endDate
+        discharge = DataDF['Discharge'].to_numpy(dtype=np.float64,
+                                                 na_value=np.nan)
+        keep &= ~(discharge < 0)
+        if 'site_no' in DataDF:
+            site = DataDF['site_no'].to_numpy(dtype=np.float64,
+                                              na_value=np.nan)
+        else:
+            site = np.full(len(DataDF), np.nan)
+        keys = GetPeriodKeys(dates[keep], self.period)
+        if len(keys) == 0:
+            return( self.Empty() )
+        if np.any(np.diff(keys) < 0) or (len(self.keys)
+                                         and keys[0] < self.keys[-1]):
+            raise ValueError("streamed rows must be in date order")
+        self.missingValues += int(np.isnan(discharge[keep]).sum())
+        self.keys = np.concatenate([self.keys, keys])
+        self.discharge = np.concatenate([self.discharge, discharge[keep]])
+        self.site = np.concatenate([self.site, site[keep]])
+        # every period before the last one seen is complete
+        return( self.Emit(self.keys[-1]) )
+
+    def Flush(self):
+        """This function reports the open period, at the end of the
+        record."""
+        if len(self.keys) == 0:
+            return( self.Empty() )
+        return( self.Emit(self.keys[-1] + 1) )
+
+    def Current(self):
+        """This function returns the metrics of the open period, computed
+        from the rows seen so far, without closing it."""
+        if len(self.keys) == 0:
+            return( self.Empty() )
+        codes = self.keys - self.keys[0]
+        result = CalcColumnMetrics(self.discharge, self.site, codes, 1,
+                                   self.colname)
+        index = GetPeriodStarts(self.keys[0], 1, self.period)
+        return( pd.DataFrame(result, index=index, columns=self.colname) )
+
+    def Emit(self, stopKey):
+        """This function computes and drops the buffered periods with keys
+        below stopKey, including empty periods in gaps of the record."""
+        if self.nextKey is None:
+            self.nextKey = self.keys[0]
+        nPeriods = stopKey - self.nextKey
+        if nPeriods <= 0:
+            return( self.Empty() )
+        nDone = np.searchsorted(self.keys, stopKey)
+        codes = self.keys[:nDone] - self.nextKey
+        result = CalcColumnMetrics(self.discharge[:nDone], self.site[:nDone],
+                                   codes, nPeriods, self.colname)
+        index = GetPeriodStarts(self.nextKey, nPeriods, self.period)
+        self.keys = self.keys[nDone:]
+        self.discharge = self.discharge[nDone:]
+        self.site = self.site[nDone:]
+        self.nextKey = stopKey
+        return( pd.DataFrame(result, index=index, columns=self.colname) )
+
+    def Empty(self):
+        """This function returns an empty metrics table."""
+        return( pd.DataFrame(columns=self.colname,
+                             index=pd.DatetimeIndex([], name='Date'),
+                             dtype=np.float64) )
+
+
+def StreamStatistics(fileName, startDate=None, endDate=None,
+                     chunkSize=100000, dateFormat='%Y-%m-%d'):
+    """This function reads an RDB file in chunks of chunkSize rows and is a
+    generator of ('annual', DataFrame) and ('monthly', DataFrame) pairs
+    holding the water years and months completed by each chunk, with the
+    columns of GetAnnualStatistics and GetMonthlyStatistics.  dateFormat
+    is '%Y-%m-%d %H:%M' for instantaneous value files."""
+    streams = {'annual': PeriodStream('WY', ANNUAL_COLUMNS, startDate,
+                                      endDate),
+               'monthly': PeriodStream('M', MONTHLY_COLUMNS, startDate,
+                                       endDate)}
+    for DataDF in ReadRDBChunks(fileName, chunkSize,
+                                columns=['site_no', 'Discharge'],
+                                dateFormat=dateFormat):
+        for name, stream in streams.items():
+            done = stream.Push(DataDF)
+            if len(done):
+                yield name, done
+    for name, stream in streams.items():
+        done = stream.Flush()
+        if len(done):
+            yield name, done
+
+
+def CollectStream(fileName, startDate=None, endDate=None, chunkSize=100000,
+                  dateFormat='%Y-%m-%d'):
+    """This function runs StreamStatistics over a whole file and returns
+    the complete annual and monthly metrics tables."""
+    tables = {'annual': [], 'monthly': []}
+    for name, done in StreamStatistics(fileName, startDate, endDate,
+                                       chunkSize, dateFormat):
+        tables[name].append(done)
+    return( pd.concat(tables['annual']), pd.concat(tables['monthly']) )
@@ -0,0 +1,148 @@
+#!/bin/env python
+"""
+Reader for USGS daily value files in the tab-delimited RDB layout.
+
+An RDB file starts with '#' comment lines, then a line of column names, a
+line of column formats (5s, 15s, 20d, ...) and the tab-delimited data rows.
+The reader skips the header block once, hands the rows to the C parser of
+pandas with fixed dtypes, parses the dates with a fixed ISO format and keeps
+the repeated text columns as categoricals.
+"""
+import numpy as np
+import pandas as pd
+
+# names given to the RDB columns that are read (datetime and the discharge
+# value and code columns are renamed)
+RDB_COLUMNS = ['agency_cd', 'site_no', 'Date', 'Discharge', 'Quality']
+
+# value codes used by the USGS in place of a discharge (equipment
+# malfunction, ice, backwater, discontinued, etc.), read as NoData
+USGS_NODATA = ['Eqp', 'Ice', 'Bkw', 'Dis', 'Dry', 'Fld', 'Mnt', 'Pr', 'Rat',
+               'Ssn', 'Tst', 'ZFl', '***']
+
+# USGS parameter code of discharge in cubic feet per second
+DISCHARGE_PARAMETER = '00060'
+
+# bump when a change of the reader changes the frames it returns, so
+# series cached from older readers are parsed again
+READER_VERSION = 1
+
+
+def ReadRDBHeader(fileName):
+    """This function scans the header block of an RDB file.  The routine
+    returns the number of lines before the first data row and the list of
+    column names given in the file."""
+    nSkip = 0
+    names = None
+    with open(fileName, 'r') as f:
+        for line in f:
+            nSkip += 1
+            if line.startswith('#'):
+                continue
+            if names is None:
+                # column names, followed by the column format line
+                names = line.rstrip('\r\n').split('\t')
+                continue
+            break
+    if names is None:
+        raise ValueError("{} has no RDB column header".format(fileName))
+    return( nSkip, names )
+
+
+def FindDischargeColumn(fileName, names, valueColumn=None):
+    """This function returns the name of the discharge value column of an
+    RDB file: valueColumn when given, otherwise the one value column with
+    the discharge parameter code (e.g. 51588_00060_00003).  A ValueError
+    is raised when there is no such column, or several and no
+    valueColumn to choose among them."""
+    if valueColumn is not None:
+        if valueColumn not in names:
+            raise ValueError("{} has no {} column".format(fileName,
+                                                          valueColumn))
+        return( valueColumn )
+    found = [name for name in names if not name.endswith('_cd') and
+             '_{}'.format(DISCHARGE_PARAMETER) in name]
+    if not found:
+        raise ValueError("{} has no discharge ({}) column".format(
+            fileName, DISCHARGE_PARAMETER))
+    if len(found) > 1:
+        raise ValueError("{} has several discharge columns ({}), choose one "
+                         "with valueColumn".format(fileName, ', '.join(found)))
+    return( found[0] )
+
+
+def GetRDBReadOptions(fileName, columns=None, valueColumn=None):
+    """This function builds the pandas.read_csv arguments used to read the
+    data rows of an RDB file.  columns is a list taken from RDB_COLUMNS;
+    the Date column is always read since it becomes the index.  The
+    discharge column is found by FindDischargeColumn."""
+    if columns is None:
+        columns = RDB_COLUMNS
+    unknown = set(columns) - set(RDB_COLUMNS)
+    if unknown:
+        raise ValueError("unknown RDB columns: {}".format(sorted(unknown)))
+    nSkip, names = ReadRDBHeader(fileName)
+    # the discharge column (e.g. 51588_00060_00003) is renamed, and its
+    # "_cd" column holds the quality codes
+    discharge = FindDischargeColumn(fileName, names, valueColumn)
+    rename = {'datetime': 'Date', discharge: 'Discharge',
+              discharge + '_cd': 'Quality'}
+    names = [rename.get(name, name) for name in names]
+    missing = [name for name in RDB_COLUMNS if name not in names]
+    if missing:
+        raise ValueError("{} has no {} column".format(fileName,
+                                                       ', '.join(missing)))
+    usecols = [name for name in RDB_COLUMNS if name in columns or name == 'Date']
+    options = dict(sep='\t', header=None, skiprows=nSkip, engine='c',
+                   names=names, usecols=usecols,
+                   dtype={'agency_cd': 'category', 'site_no': 'category',
+                          'Date': str, 'Discharge': np.float64,
+                          'Quality': 'category'},
+                   na_values={'Discharge': USGS_NODATA})
+    return( options )
+
+
+def GetReaderKey(dateFormat='%Y-%m-%d', valueColumn=None):
+    """This function returns the key naming ReadRDB with the given options
+    in a series_cache.SeriesCache: the reader version, the date format,
+    the discharge column choice and the no-data codes."""
+    return( 'usgs_rdb {} {} {} {}'.format(READER_VERSION, dateFormat,
+                                          valueColumn or DISCHARGE_PARAMETER,
+                                          ','.join(USGS_NODATA)) )
+
+
+def FormatRDBFrame(DataDF, dateFormat='%Y-%m-%d'):
+    """This function finishes a frame of raw RDB rows: the dates are parsed
+    with a fixed format and set as the index, and the site numbers are
+    turned into integer categories (leading zeros dropped, as the whitespace
+    parser of the original ReadData did)."""
+    DataDF = DataDF.set_index(pd.DatetimeIndex(
+        pd.to_datetime(DataDF.pop('Date'), format=dateFormat), name='Date'))
+    if 'site_no' in DataDF:
+        site = DataDF['site_no']
+        DataDF['site_no'] = site.cat.rename_categories(
+            pd.to_numeric(site.cat.categories).tolist())
+    return( DataDF )
+
+
+def ReadRDB(fileName, columns=None, dateFormat='%Y-%m-%d', valueColumn=None):
+    """This function reads a USGS daily value RDB file into a DataFrame
+    indexed by Date.  columns selects which of "agency_cd", "site_no",
+    "Discharge" and "Quality" are loaded (all of them by default).  The
+    USGS no-data codes, 'Eqp' among them, are read as NaN discharge.
+    valueColumn names the discharge column of files holding several."""
+    DataDF = pd.read_csv(fileName, **GetRDBReadOptions(fileName, columns,
+                                                       valueColumn))
+    return( FormatRDBFrame(DataDF, dateFormat) )
+
+
+def ReadRDBChunks(fileName, chunkSize=100000, columns=None,
+                  dateFormat='%Y-%m-%d', valueColumn=None):
+    """This function reads a USGS RDB file chunkSize rows at a time.  It is
+    a generator of DataFrames laid out as the one returned by ReadRDB, so
+    only one chunk of the file is held in memory at once."""
+    reader = pd.read_csv(fileName, chunksize=chunkSize,
+                         **GetRDBReadOptions(fileName, columns, valueColumn))
+    with reader:
+        for DataDF in reader:
+            yield FormatRDBFrame(DataDF, dateFormat)